@@ -7,6 +7,7 @@ import eecs598
 import matplotlib.pyplot as plt
 import random
 import math
+import time
 
 
 def hello_helper():
@@ -67,6 +68,25 @@ def get_toy_data(
   return toy_X, toy_y, params
 
 
+def time_function(fn, num_runs=1, num_warmup=0, synchronize=False):
+  """
+  Return the average wall-clock time in seconds of num_runs calls to fn(),
+  after num_warmup untimed calls. If synchronize is true (pass it for CUDA
+  inputs), wait for queued CUDA work before starting and stopping the
+  timer, so that asynchronous kernels are timed in full.
+  """
+  for _ in range(num_warmup):
+    fn()
+  if synchronize:
+    torch.cuda.synchronize()
+  start = time.time()
+  for _ in range(num_runs):
+    fn()
+  if synchronize:
+    torch.cuda.synchronize()
+  return (time.time() - start) / num_runs
+
+
 ################# Visualizations #################
 
 def plot_stats(stat_dict):
@@ -1,5 +1,6 @@
 from .vis import tensor_to_image, visualize_dataset
 from . import data
 from . import grad
+from . import shared_data
 from . import submit
 from .utils import reset_seed
@@ -0,0 +1,197 @@
+import json
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import torch
+
+# Layout of a shared dataset segment: a ready flag byte, the length of the
+# JSON header as 8 little-endian bytes, the header itself, then the tensors,
+# each aligned to _ALIGN bytes. The header maps each key to the offset of its
+# tensor from the start of the tensors, its shape and its dtype.
+_ALIGN = 64
+_HEADER_OFFSET = 9
+
+# Open segments of this process, by name. The tensors returned by
+# share_dataset and attach_dataset are views of these buffers, so the
+# segments must stay open for as long as the tensors are used.
+_segments = {}
+
+# Names of the segments registered with this process's resource tracker,
+# which unlinks them when it exits: those created here by share_dataset and
+# those attached with tracked=True.
+_tracked = set()
+
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _open_segment(name, tracked=False):
+    """
+    Open an existing segment without registering it with this process's
+    resource tracker, which would otherwise unlink it when we exit.
+
+    Before Python 3.13 the segment can only be opened by registering it and
+    then unregistering it. If tracked is true, the segment is already
+    registered with our tracker by the process that shares it with us, so
+    the unregister would drop that registration; it is skipped instead.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if not tracked:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _unlink_segment(name, shm):
+    """
+    Remove a segment. Before Python 3.13 unlink also unregisters the segment
+    from our resource tracker, so register it first if it is not registered
+    there, to keep the tracker's bookkeeping matched.
+    """
+    if name not in _tracked and sys.version_info < (3, 13):
+        resource_tracker.register(shm._name, "shared_memory")
+    shm.unlink()
+    _tracked.discard(name)
+
+
+def _tensors_from_segment(shm, header, data_offset):
+    data = {}
+    for key, (offset, shape, dtype) in header.items():
+        dtype = getattr(torch, dtype.split(".")[1])
+        count = 1
+        for d in shape:
+            count *= d
+        data[key] = torch.frombuffer(
+            shm.buf, dtype=dtype, count=count, offset=data_offset + offset
+        ).view(shape)
+    return data
+
+
+def share_dataset(name, data):
+    """
+    Copy a dataset into a new POSIX shared memory segment called name, so
+    that other processes (other notebooks, Solver workers, search workers)
+    can attach to it with attach_dataset without making their own copy.
+
+    The segment is removed when this process exits or calls
+    release_dataset(name, unlink=True).
+
+    Inputs:
+    - name: Name of the segment, e.g. "cifar10"
+    - data: Dictionary mapping string keys (e.g. 'X_train') to tensors; they
+      are copied to the CPU
+
+    Returns:
+    - data: Dictionary with the same keys whose tensors are views of the
+      shared segment
+    """
+    header, offset = {}, 0
+    for key, value in data.items():
+        header[key] = (offset, list(value.shape), str(value.dtype))
+        offset = _align(offset + value.numel() * value.element_size())
+    header_bytes = json.dumps(header).encode()
+    data_offset = _align(_HEADER_OFFSET + len(header_bytes))
+
+    shm = shared_memory.SharedMemory(name=name, create=True,
+                                     size=max(data_offset + offset, 1))
+    shm.buf[1:_HEADER_OFFSET] = len(header_bytes).to_bytes(8, "little")
+    shm.buf[_HEADER_OFFSET:_HEADER_OFFSET + len(header_bytes)] = header_bytes
+    shared = _tensors_from_segment(shm, header, data_offset)
+    for key, value in data.items():
+        shared[key].copy_(value)
+    shm.buf[0] = 1  # ready
+    _segments[name] = shm
+    _tracked.add(name)
+    return shared
+
+
+def attach_dataset(name, timeout=60.0, tracked=False):
+    """
+    Attach to a dataset created by share_dataset in any process, without
+    copying it. If the segment is still being filled, wait for up to timeout
+    seconds for it to become ready.
+
+    Pass tracked=True in a process started (with spawn or fork) by a process
+    for which is_tracked(name) was true: the two processes share a resource
+    tracker, and the segment is already registered with it.
+
+    Returns a dictionary mapping the keys given to share_dataset to tensors
+    that are views of the shared segment; treat them as read-only.
+    """
+    shm = _segments.get(name)
+    if shm is None:
+        shm = _open_segment(name, tracked)
+        if tracked:
+            _tracked.add(name)
+    deadline = time.time() + timeout
+    while shm.buf[0] != 1:
+        if time.time() > deadline:
+            raise TimeoutError('Shared dataset "%s" is not ready' % name)
+        time.sleep(0.01)
+    length = int.from_bytes(bytes(shm.buf[1:_HEADER_OFFSET]), "little")
+    header = json.loads(bytes(shm.buf[_HEADER_OFFSET:_HEADER_OFFSET + length]))
+    _segments[name] = shm
+    return _tensors_from_segment(shm, header, _align(_HEADER_OFFSET + length))
+
+
+def get_or_share_dataset(name, load_fn):
+    """
+    Attach to the shared dataset called name if some process already
+    created it; otherwise call load_fn() to load it (e.g. with
+    eecs598.data.cifar10 and preprocessing), share it under name and return
+    the shared copy. If several processes race here, the first one to
+    finish loading shares its copy and the others attach to it.
+    """
+    try:
+        return attach_dataset(name)
+    except FileNotFoundError:
+        pass
+    data = load_fn()
+    try:
+        return share_dataset(name, data)
+    except FileExistsError:
+        return attach_dataset(name)
+
+
+def is_tracked(name):
+    """
+    Return whether the shared dataset called name is registered with this
+    process's resource tracker, i.e. whether it was created here by
+    share_dataset or attached with tracked=True.
+    """
+    return name in _tracked
+
+
+def unlink_dataset(name):
+    """
+    Remove the shared dataset called name so that no new process can attach
+    to it. Tensors already attached to it stay valid; its memory is freed
+    once every process has closed its handle or exited.
+    """
+    shm = _segments.get(name)
+    if shm is not None:
+        _unlink_segment(name, shm)
+        return
+    shm = _open_segment(name)
+    shm.close()
+    _unlink_segment(name, shm)
+
+
+def release_dataset(name, unlink=False):
+    """
+    Close this process's handle on the shared dataset called name; every
+    tensor attached to it must have been deleted first. If unlink is true,
+    also remove the segment so that no new process can attach to it.
+    """
+    shm = _segments.pop(name, None)
+    if shm is None:
+        if unlink:
+            unlink_dataset(name)
+        return
+    shm.close()
+    if unlink:
+        _unlink_segment(name, shm)
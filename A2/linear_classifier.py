@@ -5,7 +5,15 @@ WARNING: you SHOULD NOT use ".to()" or ".cuda()" in each implementation block.
 import torch
 import random
 import statistics
+import itertools
+import time
+import os
+import multiprocessing
+import concurrent.futures
+import collections
 from abc import abstractmethod
+from eecs598.shared_data import attach_dataset, is_tracked
+from a2_helpers import time_function
 
 def hello_linear_classifier():
   """
@@ -25,15 +33,41 @@ class LinearClassifier(object):
     self.W = None
 
   def train(self, X_train, y_train, learning_rate=1e-3, reg=1e-5, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, replacement=False):
     train_args = (self.loss, self.W, X_train, y_train, learning_rate, reg,
-                  num_iters, batch_size, verbose)
+                  num_iters, batch_size, verbose, replacement)
     self.W, loss_history = train_linear_classifier(*train_args)
     return loss_history
 
+  def train_lbfgs(self, X_train, y_train, reg=1e-5, num_iters=50,
+                  history_size=10, batch_size=None, verbose=False):
+    train_args = (self.loss, self.W, X_train, y_train, reg, num_iters,
+                  history_size, batch_size, verbose)
+    self.W, loss_history = train_linear_classifier_lbfgs(*train_args)
+    return loss_history
+
   def predict(self, X):
     return predict_linear_classifier(self.W, X)
 
+  def predict_chunked(self, X, chunk_size=10000, num_threads=1):
+    return predict_linear_classifier_chunked(self.W, X, chunk_size, num_threads)
+
+  def quantize(self):
+    self.quantized_params = quantize_linear_classifier(self.W)
+    self.quantized_source = (self.W, self.W._version)
+    return self.quantized_params
+
+  def _quantized_params_stale(self):
+    if getattr(self, 'quantized_params', None) is None:
+      return True
+    W, version = self.quantized_source
+    return self.W is not W or (W is not None and W._version != version)
+
+  def predict_quantized(self, X):
+    if self._quantized_params_stale():
+      self.quantize()
+    return predict_linear_classifier_quantized(self.quantized_params, X)
+
   @abstractmethod
   def loss(self, W, X_batch, y_batch, reg):
     """
@@ -65,6 +99,15 @@ class LinearClassifier(object):
     self.W = W_dict['W']
     print("load checkpoint file: {}".format(path))
 
+  def save_quantized(self, path):
+    torch.save(self.quantize(), path)
+    print("Saved in {}".format(path))
+
+  def load_quantized(self, path):
+    self.quantized_params = torch.load(path, map_location='cpu')
+    self.quantized_source = (self.W, None if self.W is None else self.W._version)
+    print("load checkpoint file: {}".format(path))
+
 
 
 class LinearSVM(LinearClassifier):
@@ -79,6 +122,26 @@ class Softmax(LinearClassifier):
     return softmax_loss_vectorized(W, X_batch, y_batch, reg)
 
 
+class FusedLinearSVM(LinearSVM):
+  """ LinearSVM that reuses preallocated loss buffers across iterations """
+  def __init__(self):
+    super().__init__()
+    self.workspace = {}
+
+  def loss(self, W, X_batch, y_batch, reg):
+    return svm_loss_fused(W, X_batch, y_batch, reg, self.workspace)
+
+
+class FusedSoftmax(Softmax):
+  """ Softmax that reuses preallocated loss buffers across iterations """
+  def __init__(self):
+    super().__init__()
+    self.workspace = {}
+
+  def loss(self, W, X_batch, y_batch, reg):
+    return softmax_loss_fused(W, X_batch, y_batch, reg, self.workspace)
+
+
 
 #**************************************************#
 ################## Section 1: SVM ##################
@@ -212,6 +275,40 @@ def svm_loss_vectorized(W, X, y, reg):
   return loss, dW
 
 
+def svm_loss_batched(W, X, y, reg):
+  """
+  Structured SVM loss function for a stack of K weight matrices evaluated on
+  the same minibatch; each W[k] gives the same loss and gradient as
+  svm_loss_vectorized(W[k], X, y, reg[k]).
+
+  Inputs:
+  - W: A PyTorch tensor of shape (K, D, C) containing K weight matrices.
+  - X: A PyTorch tensor of shape (N, D) containing a minibatch of data.
+  - y: A PyTorch tensor of shape (N,) containing training labels.
+  - reg: A PyTorch tensor of shape (K,) giving the regularization strength
+    of each weight matrix.
+
+  Returns a tuple of:
+  - loss: tensor of shape (K,)
+  - gradient of loss with respect to W; a tensor of same shape as W
+  """
+  K = W.shape[0]
+  num_train = X.shape[0]
+  rows = torch.arange(num_train, device=X.device)
+
+  scores = torch.matmul(X, W)
+  correct_class_scores = scores[:, rows, y].unsqueeze(2)
+  margins = (scores - correct_class_scores + 1).clamp(min=0)
+  margins[:, rows, y] = 0
+  loss = margins.sum(dim=(1, 2)) / num_train + reg * (W * W).sum(dim=(1, 2))
+
+  binary_margins = (margins > 0).to(X.dtype)
+  binary_margins[:, rows, y] -= binary_margins.sum(dim=2)
+  dW = torch.matmul(X.t(), binary_margins) / num_train + 2 * reg.view(K, 1, 1) * W
+
+  return loss, dW
+
+
 def sample_batch(X, y, num_train, batch_size):
   """
   Sample batch_size elements from the training data and their
@@ -237,9 +334,60 @@ def sample_batch(X, y, num_train, batch_size):
   return X_batch, y_batch
 
 
+class BatchSampler(object):
+  """
+  Draws training minibatches from (X, y). By default the data is shuffled
+  once per epoch into a contiguous buffer, and each minibatch is a zero-copy
+  slice of that buffer rather than a fresh gather of batch_size rows. With
+  replacement=True it falls back to sample_batch, which reproduces the
+  original sampling-with-replacement behaviour.
+  """
+  def __init__(self, X, y, batch_size, replacement=False):
+    """
+    Inputs:
+    - X: A PyTorch tensor of shape (N, D) containing training data.
+    - y: A PyTorch tensor of shape (N,) containing training labels.
+    - batch_size: (integer) number of training examples per minibatch.
+    - replacement: (boolean) If true, sample every minibatch independently
+      with replacement using sample_batch.
+    """
+    self.X = X
+    self.y = y
+    self.num_train = X.shape[0]
+    self.batch_size = batch_size
+    self.replacement = replacement
+    self.X_perm = None
+    self.y_perm = None
+    self.pos = self.num_train  # shuffle on the first call
+
+  def next_batch(self):
+    """
+    Returns a tuple (X_batch, y_batch). Without replacement these are views
+    into the shuffled buffer, which are overwritten at the next epoch.
+    """
+    if self.replacement:
+      return sample_batch(self.X, self.y, self.num_train, self.batch_size)
+
+    batch_size = min(self.batch_size, self.num_train)
+    if self.pos + batch_size > self.num_train:
+      self._shuffle()
+    start = self.pos
+    self.pos += batch_size
+    return self.X_perm[start:self.pos], self.y_perm[start:self.pos]
+
+  def _shuffle(self):
+    perm = torch.randperm(self.num_train, device=self.X.device)
+    if self.X_perm is None:
+      self.X_perm = torch.empty_like(self.X, memory_format=torch.contiguous_format)
+      self.y_perm = torch.empty_like(self.y)
+    torch.index_select(self.X, 0, perm, out=self.X_perm)
+    torch.index_select(self.y, 0, perm, out=self.y_perm)
+    self.pos = 0
+
+
 def train_linear_classifier(loss_func, W, X, y, learning_rate=1e-3,
                             reg=1e-5, num_iters=100, batch_size=200,
-                            verbose=False):
+                            verbose=False, replacement=False):
   """
   Train this linear classifier using stochastic gradient descent.
 
@@ -257,6 +405,9 @@ def train_linear_classifier(loss_func, W, X, y, learning_rate=1e-3,
   - num_iters: (integer) number of steps to take when optimizing
   - batch_size: (integer) number of training examples to use at each step.
   - verbose: (boolean) If true, print progress during optimization.
+  - replacement: (boolean) If true, sample minibatches with replacement as
+    sample_batch does; otherwise shuffle the data once per epoch with a
+    BatchSampler.
 
   Returns: A tuple of:
   - W: The final value of the weight matrix and the end of optimization
@@ -273,10 +424,10 @@ def train_linear_classifier(loss_func, W, X, y, learning_rate=1e-3,
     num_classes = W.shape[1]
 
   # Run stochastic gradient descent to optimize W
+  sampler = BatchSampler(X, y, batch_size, replacement)
   loss_history = []
   for it in range(num_iters):
-    # TODO: implement sample_batch function
-    X_batch, y_batch = sample_batch(X, y, num_train, batch_size)
+    X_batch, y_batch = sampler.next_batch()
 
     # evaluate loss and gradient
     loss, grad = loss_func(W, X_batch, y_batch, reg)
@@ -327,6 +478,360 @@ def predict_linear_classifier(W, X):
   return y_pred
 
 
+def train_linear_classifier_batched(loss_func, W, X, y, learning_rates, regs,
+                                    num_iters=100, batch_size=200,
+                                    verbose=False, replacement=False):
+  """
+  Train K linear classifiers with different learning rates and regularization
+  strengths at once. All K weight matrices are stacked into a single
+  (K, D, C) tensor and updated on the same minibatches.
+
+  Inputs:
+  - loss_func: batched loss function to use when training, such as
+    svm_loss_batched or softmax_loss_batched
+  - W: A PyTorch tensor of shape (K, D, C) giving the initial weights. If W is
+    None then every classifier is initialized with the same random weights,
+    exactly as train_linear_classifier would initialize a single one.
+  - X, y: Training data and labels, as for train_linear_classifier.
+  - learning_rates: list of K learning rates.
+  - regs: list of K regularization strengths.
+  - num_iters, batch_size, verbose, replacement: Same as for
+    train_linear_classifier.
+
+  Returns: A tuple of:
+  - W: The final weights, of shape (K, D, C)
+  - loss_history: A list giving, for each iteration, a list of the K losses
+  """
+  num_train, dim = X.shape
+  lr = torch.tensor(learning_rates, dtype=X.dtype, device=X.device).view(-1, 1, 1)
+  reg = torch.tensor(regs, dtype=X.dtype, device=X.device)
+  K = lr.shape[0]
+  if W is None:
+    # lazily initialize W
+    num_classes = torch.max(y) + 1
+    W = 0.000001 * torch.randn(dim, num_classes, device=X.device, dtype=X.dtype)
+    W = W.repeat(K, 1, 1)
+
+  sampler = BatchSampler(X, y, batch_size, replacement)
+  loss_history = []
+  for it in range(num_iters):
+    X_batch, y_batch = sampler.next_batch()
+
+    # evaluate loss and gradient of every classifier
+    loss, grad = loss_func(W, X_batch, y_batch, reg)
+    loss_history.append(loss.tolist())
+
+    W -= lr * grad
+
+    if verbose and it % 100 == 0:
+      print('iteration %d / %d: min loss %f' % (it, num_iters, loss.min()))
+
+  return W, loss_history
+
+
+def predict_linear_classifier_batched(W, X):
+  """
+  Predict labels for X with each of K stacked linear classifiers.
+
+  Inputs:
+  - W: A PyTorch tensor of shape (K, D, C)
+  - X: A PyTorch tensor of shape (N, D)
+
+  Returns:
+  - y_pred: PyTorch int64 tensor of shape (K, N)
+  """
+  return torch.matmul(X, W).argmax(dim=2)
+
+
+def train_linear_classifier_lbfgs(loss_func, W, X, y, reg=1e-5, num_iters=50,
+                                  history_size=10, batch_size=None,
+                                  verbose=False):
+  """
+  Train this linear classifier with full-batch (or large-batch) L-BFGS. Since
+  the SVM and softmax objectives are convex, a few dozen quasi-Newton steps
+  on the whole training set replace thousands of noisy SGD steps. Each step
+  uses the two-loop recursion over the last history_size updates to pick a
+  search direction, followed by a backtracking (Armijo) line search.
+
+  Inputs:
+  - loss_func, W, X, y, reg, verbose: Same as for train_linear_classifier.
+  - num_iters: (integer) number of L-BFGS steps to take.
+  - history_size: (integer) number of past updates used to approximate the
+    inverse Hessian.
+  - batch_size: (integer) If not None, optimize on a fixed random subset of
+    batch_size training examples instead of the full training set.
+
+  Returns: A tuple of:
+  - W: The final value of the weight matrix and the end of optimization
+  - loss_history: A list of Python scalars giving the value of the loss after
+    each L-BFGS step, starting with the initial loss.
+  """
+  num_train, dim = X.shape
+  if W is None:
+    # lazily initialize W
+    num_classes = torch.max(y) + 1
+    W = 0.000001 * torch.randn(dim, num_classes, device=X.device, dtype=X.dtype)
+  if batch_size is not None and batch_size < num_train:
+    indices = torch.randperm(num_train, device=X.device)[:batch_size]
+    X, y = X[indices], y[indices]
+
+  loss, grad = loss_func(W, X, y, reg)
+  loss, grad = loss.item(), grad.clone()
+  s_history, y_history = [], []
+  loss_history = [loss]
+  for it in range(num_iters):
+    # Two-loop recursion: direction = -H * grad
+    q = grad.clone()
+    alphas = []
+    for s_k, y_k in zip(reversed(s_history), reversed(y_history)):
+      alpha = (s_k * q).sum() / (y_k * s_k).sum()
+      q -= alpha * y_k
+      alphas.append(alpha)
+    if s_history:
+      q *= (s_history[-1] * y_history[-1]).sum() / (y_history[-1] * y_history[-1]).sum()
+    else:
+      q *= min(1.0, 1.0 / grad.abs().sum().item())
+    for (s_k, y_k), alpha in zip(zip(s_history, y_history), reversed(alphas)):
+      beta = (y_k * q).sum() / (y_k * s_k).sum()
+      q += (alpha - beta) * s_k
+    direction = -q
+
+    # Fall back to steepest descent if this is not a descent direction
+    slope = (grad * direction).sum().item()
+    if slope >= 0:
+      s_history, y_history = [], []
+      direction = -grad * min(1.0, 1.0 / grad.abs().sum().item())
+      slope = (grad * direction).sum().item()
+
+    # Backtracking line search with the Armijo condition
+    step = 1.0
+    while True:
+      W_new = W + step * direction
+      loss_new, grad_new = loss_func(W_new, X, y, reg)
+      loss_new = loss_new.item()
+      if loss_new <= loss + 1e-4 * step * slope or step < 1e-10:
+        break
+      step *= 0.5
+
+    s_k, y_k = W_new - W, grad_new - grad
+    if (s_k * y_k).sum().item() > 1e-10:
+      s_history.append(s_k)
+      y_history.append(y_k)
+      if len(s_history) > history_size:
+        s_history.pop(0)
+        y_history.pop(0)
+    W, loss, grad = W_new, loss_new, grad_new.clone()
+    loss_history.append(loss)
+
+    if verbose and it % 10 == 0:
+      print('iteration %d / %d: loss %f' % (it, num_iters, loss))
+
+  return W, loss_history
+
+
+def compare_sgd_lbfgs(cls, data_dict, learning_rate, reg, sgd_iters=2000,
+                      lbfgs_iters=50):
+  """
+  Train one instance of cls with SGD and one with full-batch L-BFGS, and
+  report the wall-clock time and accuracies of both.
+
+  Inputs:
+  - cls: LinearSVM or Softmax (the class, not an instance)
+  - data_dict (dict): Same as for test_one_param_set
+  - learning_rate, reg: Hyperparameters for SGD; reg is also used by L-BFGS
+  - sgd_iters, lbfgs_iters: Number of steps taken by each optimizer
+
+  Returns a dictionary mapping 'sgd' and 'lbfgs' to dictionaries with the
+  keys 'time', 'train_acc' and 'val_acc'.
+  """
+  X_train, y_train, X_val, y_val = (
+      data_dict['X_train'], data_dict['y_train'],
+      data_dict['X_val'], data_dict['y_val']
+    )
+  results = {}
+  for name in ['sgd', 'lbfgs']:
+    model = cls()
+    if name == 'sgd':
+      train = lambda: model.train(X_train, y_train, learning_rate=learning_rate,
+                                  reg=reg, num_iters=sgd_iters)
+    else:
+      train = lambda: model.train_lbfgs(X_train, y_train, reg=reg,
+                                        num_iters=lbfgs_iters)
+    elapsed = time_function(train, synchronize=X_train.is_cuda)
+    results[name] = {
+      'time': elapsed,
+      'train_acc': (model.predict(X_train) == y_train).float().mean().item(),
+      'val_acc': (model.predict(X_val) == y_val).float().mean().item(),
+    }
+    print('%s: %.2f sec, train accuracy: %f val accuracy: %f'
+          % (name, elapsed, results[name]['train_acc'], results[name]['val_acc']))
+  return results
+
+
+def _iter_chunks(X, chunk_size):
+  """
+  Yield consecutive chunks of at most chunk_size rows from a tensor or array
+  (including a numpy memmap); any other iterable is assumed to already yield
+  batches and is passed through unchanged.
+  """
+  if hasattr(X, 'shape'):
+    for start in range(0, X.shape[0], chunk_size):
+      yield X[start:start + chunk_size]
+  else:
+    yield from X
+
+
+def predict_in_chunks(predict_fn, X, chunk_size=10000, num_threads=1,
+                      dtype=None, device=None):
+  """
+  Run predict_fn over X one chunk at a time on a thread pool, so that peak
+  memory is bounded by a few chunks rather than the whole input. At most
+  2 * num_threads chunks are loaded at any time.
+
+  Inputs:
+  - predict_fn: A function mapping a tensor of shape (B, D) to a tensor of
+    predicted labels of shape (B,)
+  - X: A tensor or array of shape (N, D), a numpy memmap of that shape, or
+    an iterable of batches of shape (B, D)
+  - chunk_size: Number of rows per chunk when X is a tensor or array
+  - num_threads: Number of threads used to score chunks concurrently
+  - dtype, device: Data type and device each chunk is converted to
+
+  Returns:
+  - y_pred: int64 tensor of shape (N,) giving the predicted labels, in order
+  """
+  def predict_chunk(chunk):
+    if torch.is_tensor(chunk):
+      chunk = torch.as_tensor(chunk, dtype=dtype, device=device)
+    else:
+      chunk = torch.tensor(chunk, dtype=dtype, device=device)
+    return predict_fn(chunk)
+
+  y_pred = []
+  with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+    pending = collections.deque()
+    for chunk in _iter_chunks(X, chunk_size):
+      pending.append(executor.submit(predict_chunk, chunk))
+      if len(pending) >= 2 * num_threads:
+        y_pred.append(pending.popleft().result())
+    while pending:
+      y_pred.append(pending.popleft().result())
+  return torch.cat(y_pred)
+
+
+def predict_linear_classifier_chunked(W, X, chunk_size=10000, num_threads=1):
+  """
+  Streaming version of predict_linear_classifier for large inputs; see
+  predict_in_chunks for the accepted types of X.
+  """
+  return predict_in_chunks(lambda X_chunk: predict_linear_classifier(W, X_chunk),
+                           X, chunk_size, num_threads, W.dtype, W.device)
+
+
+def quantize_per_channel(W):
+  """
+  Symmetric int8 quantization of a weight matrix with one scale per output
+  channel (column of W), so that W is approximately W_q * scale.
+
+  Inputs:
+  - W: A PyTorch tensor of shape (D, C)
+
+  Returns a tuple of:
+  - W_q: int8 CPU tensor of shape (D, C)
+  - scale: float32 CPU tensor of shape (C,)
+  """
+  W = W.detach().cpu().float()
+  scale = W.abs().amax(dim=0).clamp(min=1e-12) / 127
+  W_q = torch.round(W / scale).clamp(-127, 127).to(torch.int8)
+  return W_q, scale
+
+
+def _quantize_rows(X):
+  """
+  Dynamic symmetric int8 quantization of the activations X with one scale
+  per row. Returns (X_q, scale) with scale of shape (N, 1).
+  """
+  scale = X.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / 127
+  X_q = torch.round(X / scale).clamp(-127, 127).to(torch.int8)
+  return X_q, scale
+
+
+def _int8_mm(A_q, B_q):
+  """
+  Multiply two int8 matrices with int32 accumulation, using the int8 GEMM
+  kernel where this version of PyTorch provides one for these shapes.
+  """
+  try:
+    return torch._int_mm(A_q, B_q)
+  except (AttributeError, RuntimeError):
+    return torch.mm(A_q.int(), B_q.int())
+
+
+def quantized_linear(X, W_q, W_scale):
+  """
+  Compute X.mm(W) on the CPU using int8 inputs and int32 accumulation, where
+  (W_q, W_scale) come from quantize_per_channel and X is quantized per row
+  on the fly. Returns a float32 tensor of shape (N, C).
+  """
+  X_q, X_scale = _quantize_rows(X.cpu().float())
+  return _int8_mm(X_q, W_q).float() * X_scale * W_scale
+
+
+def quantize_linear_classifier(W):
+  """
+  Export the weights of a linear classifier as int8 with per-class scales.
+  Returns a dictionary with keys 'W_q' and 'W_scale' that can be saved with
+  torch.save and used with predict_linear_classifier_quantized.
+  """
+  W_q, W_scale = quantize_per_channel(W)
+  return {'W_q': W_q, 'W_scale': W_scale}
+
+
+def predict_linear_classifier_quantized(quantized_params, X):
+  """
+  Same as predict_linear_classifier, but using the int8 weights returned by
+  quantize_linear_classifier. Runs on the CPU and returns labels on the CPU.
+  """
+  scores = quantized_linear(X, quantized_params['W_q'], quantized_params['W_scale'])
+  return torch.argmax(scores, dim=1)
+
+
+def _params_nbytes(params):
+  return sum(v.numel() * v.element_size() for v in params.values())
+
+
+def compare_quantized(model, X, y, num_runs=10):
+  """
+  Compare the float and int8 inference paths of a trained LinearClassifier
+  or TwoLayerNet on (X, y): print the accuracy of each, the accuracy delta,
+  the size of the exported parameters and the time per predict call.
+  Pass CPU tensors (and a model on the CPU) for a like-for-like timing.
+
+  Returns a dictionary mapping 'float' and 'int8' to a dictionary with
+  keys 'acc', 'bytes' and 'time'.
+  """
+  float_params = model.params if hasattr(model, 'params') else {'W': model.W}
+  quantized_params = model.quantize()
+
+  results = {}
+  for name, predict, params in [
+      ('float', model.predict, float_params),
+      ('int8', model.predict_quantized, quantized_params)]:
+    y_pred = predict(X)  # warm up
+    elapsed = time_function(lambda: predict(X), num_runs, synchronize=X.is_cuda)
+    results[name] = {
+      'acc': (y_pred.cpu() == y.cpu()).float().mean().item(),
+      'bytes': _params_nbytes(params),
+      'time': elapsed,
+    }
+    print('%s: accuracy %f, %d bytes, %.2f ms per predict'
+          % (name, results[name]['acc'], results[name]['bytes'], 1000 * elapsed))
+  print('accuracy delta: %f, speedup: %.2fx'
+        % (results['int8']['acc'] - results['float']['acc'],
+           results['float']['time'] / results['int8']['time']))
+  return results
+
+
 def svm_get_search_params():
   """
   Return candidate hyperparameters for the SVM model. You should provide
@@ -412,6 +917,150 @@ def test_one_param_set(cls, data_dict, lr, reg, num_iters=2000):
   return cls, train_acc, val_acc
 
 
+def test_param_sets_batched(cls, data_dict, learning_rates,
+                            regularization_strengths, num_iters=2000):
+  """
+  Batched version of test_one_param_set: train one classifier for every
+  (lr, reg) pair of the grid in a single run, using
+  train_linear_classifier_batched. Since every classifier starts from the
+  same seed, each one sees the same initial weights and minibatches as it
+  would in test_one_param_set.
+
+  Inputs:
+  - cls: LinearSVM or Softmax (the class, not an instance)
+  - data_dict (dict): Same as for test_one_param_set
+  - learning_rates: list of learning rate candidates
+  - regularization_strengths: list of regularization strength candidates
+  - num_iters (int, optional): a number of iterations to train
+
+  Returns:
+  - results (dict): maps each (lr, reg) pair to a tuple
+                    (trained cls instance, train_acc, val_acc)
+  """
+  if issubclass(cls, Softmax):
+    loss_func = softmax_loss_batched
+  elif issubclass(cls, LinearSVM):
+    loss_func = svm_loss_batched
+  else:
+    raise ValueError('Unsupported classifier class "%s"' % cls.__name__)
+  X_train, y_train, X_val, y_val = (
+      data_dict['X_train'], data_dict['y_train'],
+      data_dict['X_val'], data_dict['y_val']
+    )
+  pairs = list(itertools.product(learning_rates, regularization_strengths))
+
+  random.seed(0)
+  torch.manual_seed(0)
+  W, _ = train_linear_classifier_batched(
+      loss_func, None, X_train, y_train,
+      [lr for lr, _ in pairs], [reg for _, reg in pairs], num_iters)
+
+  train_acc = (predict_linear_classifier_batched(W, X_train) == y_train).float().mean(dim=1)
+  val_acc = (predict_linear_classifier_batched(W, X_val) == y_val).float().mean(dim=1)
+
+  results = {}
+  for k, (lr, reg) in enumerate(pairs):
+    model = cls()
+    model.W = W[k].clone()
+    results[(lr, reg)] = (model, train_acc[k].item(), val_acc[k].item())
+  return results
+
+
+
+_search_state = {}
+
+
+def _search_init(train_fn, data_dict, num_threads, tracked):
+  # Workers are forked, so train_fn and data_dict are inherited rather than
+  # pickled; limit each worker's intra-op threads to avoid oversubscription.
+  # Forked workers share our resource tracker, so a dataset tracked by us
+  # is already tracked by them
+  torch.set_num_threads(num_threads)
+  if isinstance(data_dict, str):
+    data_dict = attach_dataset(data_dict, tracked=tracked)
+  _search_state['train_fn'] = train_fn
+  _search_state['data_dict'] = data_dict
+
+
+def _search_run(index, config):
+  return index, config, _search_state['train_fn'](_search_state['data_dict'], *config)
+
+
+def parallel_search(train_fn, data_dict, configs, num_workers=None,
+                    threads_per_worker=1):
+  """
+  Evaluate hyperparameter configurations concurrently in a pool of forked
+  worker processes, yielding results as soon as each one finishes.
+
+  Inputs:
+  - train_fn: A function called as train_fn(data_dict, *config) in a worker
+    process; its return value must be picklable
+  - data_dict (dict): Training / validation data; must live on the CPU. May
+    also be the name of a dataset shared with
+    eecs598.shared_data.share_dataset, which each worker attaches to
+  - configs: A list of tuples of hyperparameters
+  - num_workers (int, optional): Number of worker processes; defaults to
+    the number of CPUs divided by threads_per_worker
+  - threads_per_worker (int, optional): Number of PyTorch threads per worker
+
+  Yields tuples (index, config, result) in completion order, where index is
+  the position of config in configs.
+  """
+  if isinstance(data_dict, dict) and any(
+      torch.is_tensor(v) and v.is_cuda for v in data_dict.values()):
+    raise ValueError('parallel_search requires the data to be on the CPU')
+  if num_workers is None:
+    num_workers = max((os.cpu_count() or 1) // threads_per_worker, 1)
+
+  tracked = isinstance(data_dict, str) and is_tracked(data_dict)
+  ctx = multiprocessing.get_context('fork')
+  with concurrent.futures.ProcessPoolExecutor(
+      num_workers, mp_context=ctx, initializer=_search_init,
+      initargs=(train_fn, data_dict, threads_per_worker, tracked)) as executor:
+    futures = [executor.submit(_search_run, i, config)
+               for i, config in enumerate(configs)]
+    for future in concurrent.futures.as_completed(futures):
+      yield future.result()
+
+
+def _train_linear_param_set(data_dict, cls, lr, reg, num_iters):
+  model, train_acc, val_acc = test_one_param_set(cls(), data_dict, lr, reg, num_iters)
+  return model.W, train_acc, val_acc
+
+
+def test_param_sets_parallel(cls, data_dict, learning_rates,
+                             regularization_strengths, num_iters=2000,
+                             num_workers=None, threads_per_worker=1,
+                             verbose=True):
+  """
+  Run test_one_param_set for every (lr, reg) pair of the grid concurrently
+  with parallel_search.
+
+  Inputs:
+  - cls: LinearSVM or Softmax (the class, not an instance)
+  - data_dict, learning_rates, regularization_strengths, num_iters: Same as
+    for test_param_sets_batched
+  - num_workers, threads_per_worker: Same as for parallel_search
+  - verbose (boolean): If true, print each result as it finishes
+
+  Returns:
+  - results (dict): maps each (lr, reg) pair to a tuple
+                    (trained cls instance, train_acc, val_acc)
+  """
+  configs = [(cls, lr, reg, num_iters) for lr, reg in
+             itertools.product(learning_rates, regularization_strengths)]
+  results = {}
+  for _, (_, lr, reg, _), (W, train_acc, val_acc) in parallel_search(
+      _train_linear_param_set, data_dict, configs, num_workers,
+      threads_per_worker):
+    model = cls()
+    model.W = W
+    results[(lr, reg)] = (model, train_acc, val_acc)
+    if verbose:
+      print('lr %e reg %e train accuracy: %f val accuracy: %f'
+            % (lr, reg, train_acc, val_acc))
+  return results
+
 
 #**************************************************#
 ################ Section 2: Softmax ################
@@ -529,6 +1178,167 @@ def softmax_loss_vectorized(W, X, y, reg):
   return loss, dW
 
 
+def softmax_loss_batched(W, X, y, reg):
+  """
+  Softmax loss function for a stack of K weight matrices evaluated on the
+  same minibatch; each W[k] gives the same loss and gradient as
+  softmax_loss_vectorized(W[k], X, y, reg[k]).
+
+  Inputs and outputs are the same as svm_loss_batched.
+  """
+  K = W.shape[0]
+  num_train = X.shape[0]
+  rows = torch.arange(num_train, device=X.device)
+
+  scores = torch.matmul(X, W)
+  scores -= scores.max(dim=2, keepdim=True).values
+  probs = scores.exp_()
+  probs /= probs.sum(dim=2, keepdim=True)
+
+  loss = -probs[:, rows, y].log().sum(dim=1) / num_train
+  loss += reg * (W * W).sum(dim=(1, 2))
+
+  probs[:, rows, y] -= 1
+  dW = torch.matmul(X.t(), probs) / num_train + 2 * reg.view(K, 1, 1) * W
+
+  return loss, dW
+
+
+def workspace_buffer(workspace, name, shape, dtype, device):
+  """
+  Return the buffer stored under name in workspace, reallocating it only if
+  its shape, dtype or device changed since the last call.
+  """
+  buf = workspace.get(name)
+  if buf is None or buf.shape != shape or buf.dtype != dtype or buf.device != device:
+    buf = torch.empty(shape, dtype=dtype, device=device)
+    workspace[name] = buf
+  return buf
+
+
+def svm_loss_fused(W, X, y, reg, workspace=None):
+  """
+  Low-allocation version of svm_loss_vectorized that gives identical results.
+  Scores, margins and the gradient are computed in place in buffers kept in
+  workspace, so that repeated calls with the same shapes (e.g. from
+  train_linear_classifier) do not allocate any (N, C) or (D, C) tensors.
+
+  Inputs: Same as svm_loss_vectorized, plus
+  - workspace: Optional dictionary of buffers reused across calls
+
+  Returns: Same as svm_loss_vectorized. Note that the returned gradient is a
+  workspace buffer and is overwritten by the next call.
+  """
+  if workspace is None:
+    workspace = {}
+  (num_train, dim), num_classes = X.shape, W.shape[1]
+  buf = lambda name, shape: workspace_buffer(workspace, name, shape, W.dtype, W.device)
+  y_col = y.view(-1, 1)
+
+  margins = torch.mm(X, W, out=buf('scores', (num_train, num_classes)))
+  correct_class_scores = torch.gather(margins, 1, y_col, out=buf('correct', (num_train, 1)))
+  margins.sub_(correct_class_scores).add_(1).clamp_(min=0)
+  margins.scatter_(1, y_col, 0)
+  W_sq = torch.mul(W, W, out=buf('W_sq', (dim, num_classes)))
+  loss = torch.sum(margins) / num_train + reg * torch.sum(W_sq)
+
+  binary_margins = margins.sign_()
+  row_sum = torch.sum(binary_margins, dim=1, keepdim=True, out=buf('row_sum', (num_train, 1)))
+  binary_margins.scatter_(1, y_col, row_sum.neg_())
+  dW = torch.mm(X.t(), binary_margins, out=buf('dW', (dim, num_classes)))
+  dW.div_(num_train).add_(torch.mul(W, 2 * reg, out=W_sq))
+
+  return loss, dW
+
+
+def softmax_loss_fused(W, X, y, reg, workspace=None):
+  """
+  Low-allocation version of softmax_loss_vectorized that gives identical
+  results, using an in-place log-sum-exp over buffers kept in workspace.
+
+  Inputs / outputs: Same as svm_loss_fused.
+  """
+  if workspace is None:
+    workspace = {}
+  (num_train, dim), num_classes = X.shape, W.shape[1]
+  buf = lambda name, shape: workspace_buffer(workspace, name, shape, W.dtype, W.device)
+  y_col = y.view(-1, 1)
+
+  probs = torch.mm(X, W, out=buf('scores', (num_train, num_classes)))
+  probs.sub_(torch.amax(probs, dim=1, keepdim=True, out=buf('row_max', (num_train, 1))))
+  probs.exp_()
+  probs.div_(torch.sum(probs, dim=1, keepdim=True, out=buf('row_sum', (num_train, 1))))
+
+  correct_probs = torch.gather(probs, 1, y_col, out=buf('correct', (num_train, 1)))
+  loss = -torch.log(correct_probs).sum()
+  loss /= num_train
+  W_sq = torch.mul(W, W, out=buf('W_sq', (dim, num_classes)))
+  loss += reg * torch.sum(W_sq)
+
+  probs.scatter_(1, y_col, correct_probs.sub_(1))
+  dW = torch.mm(X.t(), probs, out=buf('dW', (dim, num_classes)))
+  dW.div_(num_train).add_(torch.mul(W, 2 * reg, out=W_sq))
+
+  return loss, dW
+
+
+def benchmark_loss_kernels(X, y, num_classes=10, reg=1e-3, batch_size=200,
+                           num_runs=100):
+  """
+  Compare the latency and memory allocated per call of the vectorized and
+  fused SVM / softmax loss kernels on minibatches of X, and check that they
+  give the same results.
+
+  Inputs:
+  - X, y: Data and labels to draw a minibatch of batch_size examples from
+  - num_classes: Number of classes C
+  - reg: Regularization strength
+  - batch_size: Size of the minibatch
+  - num_runs: Number of calls to average the latency over
+
+  Returns a dictionary mapping kernel names to a tuple
+  (seconds per call, bytes allocated per call).
+  """
+  torch.manual_seed(0)
+  X_batch, y_batch = sample_batch(X, y, X.shape[0], batch_size)
+  W = 0.000001 * torch.randn(X.shape[1], num_classes, dtype=X.dtype, device=X.device)
+
+  def measure(loss_func):
+    loss_func(W, X_batch, y_batch, reg)  # warm up the workspace
+    if X.is_cuda:
+      torch.cuda.synchronize()
+      torch.cuda.reset_peak_memory_stats()
+      base = torch.cuda.memory_allocated()
+    elapsed = time_function(lambda: loss_func(W, X_batch, y_batch, reg),
+                            num_runs, synchronize=X.is_cuda)
+    if X.is_cuda:
+      allocated = torch.cuda.max_memory_allocated() - base
+    else:
+      with torch.profiler.profile(profile_memory=True) as prof:
+        loss_func(W, X_batch, y_batch, reg)
+      allocated = sum(max(e.self_cpu_memory_usage, 0) for e in prof.key_averages())
+    return elapsed, allocated
+
+  results = {}
+  for name, vectorized, fused in [
+      ('svm', svm_loss_vectorized, svm_loss_fused),
+      ('softmax', softmax_loss_vectorized, softmax_loss_fused)]:
+    workspace = {}
+    fused_func = lambda W, X, y, reg: fused(W, X, y, reg, workspace)
+    loss_v, dW_v = vectorized(W, X_batch, y_batch, reg)
+    loss_f, dW_f = fused_func(W, X_batch, y_batch, reg)
+    print('%s max difference: loss %e, dW %e'
+          % (name, (loss_v - loss_f).abs().item(), (dW_v - dW_f).abs().max().item()))
+
+    results[name + '_vectorized'] = measure(vectorized)
+    results[name + '_fused'] = measure(fused_func)
+    for kind in ['vectorized', 'fused']:
+      elapsed, allocated = results[name + '_' + kind]
+      print('%s %s: %.3f ms, %d bytes allocated per call'
+            % (name, kind, 1000 * elapsed, allocated))
+  return results
+
+
 def softmax_get_search_params():
   """
   Return candidate hyperparameters for the Softmax model. You should provide
@@ -5,8 +5,14 @@ WARNING: you SHOULD NOT use ".to()" or ".cuda()" in each implementation block.
 import torch
 import random
 import statistics
-from linear_classifier import sample_batch
+from linear_classifier import BatchSampler, parallel_search, predict_in_chunks
+from linear_classifier import workspace_buffer
+from linear_classifier import quantize_per_channel, quantized_linear
+from eecs598.shared_data import attach_dataset
+from a2_helpers import time_function
 import itertools
+import math
+import time
 
 
 def hello_two_layer_net():
@@ -55,18 +61,53 @@ class TwoLayerNet(object):
   def train(self, X, y, X_val, y_val,
             learning_rate=1e-3, learning_rate_decay=0.95,
             reg=5e-6, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, replacement=False,
+            patience=None, val_probe_size=None, start_iter=0, sampler=None):
     return nn_train(
             self.params,
             nn_forward_backward,
             nn_predict,
             X, y, X_val, y_val,
             learning_rate, learning_rate_decay,
-            reg, num_iters, batch_size, verbose)
+            reg, num_iters, batch_size, verbose, replacement,
+            patience, val_probe_size, start_iter, sampler)
+
+  def train_fused(self, X, y, X_val, y_val,
+                  learning_rate=1e-3, learning_rate_decay=0.95,
+                  reg=5e-6, num_iters=100,
+                  batch_size=200, verbose=False, replacement=False):
+    if not hasattr(self, 'workspace'):
+      self.workspace = {}
+    return nn_train_fused(
+            self.params,
+            X, y, X_val, y_val,
+            learning_rate, learning_rate_decay,
+            reg, num_iters, batch_size, verbose, replacement,
+            self.workspace)
 
   def predict(self, X):
     return nn_predict(self.params, nn_forward_backward, X)
 
+  def predict_chunked(self, X, chunk_size=10000, num_threads=1):
+    return nn_predict_chunked(self.params, nn_forward_backward, X,
+                              chunk_size, num_threads)
+
+  def quantize(self):
+    self.quantized_params = nn_quantize(self.params)
+    self.quantized_sources = {k: (v, v._version) for k, v in self.params.items()}
+    return self.quantized_params
+
+  def _quantized_params_stale(self):
+    if getattr(self, 'quantized_params', None) is None:
+      return True
+    return any(self.params.get(k) is not v or v._version != version
+               for k, (v, version) in self.quantized_sources.items())
+
+  def predict_quantized(self, X):
+    if self._quantized_params_stale():
+      self.quantize()
+    return nn_predict_quantized(self.quantized_params, X)
+
   def save(self, path):
     torch.save(self.params, path)
     print("Saved in {}".format(path))
@@ -76,6 +117,15 @@ class TwoLayerNet(object):
     self.params = checkpoint
     print("load checkpoint file: {}".format(path))
 
+  def save_quantized(self, path):
+    torch.save(self.quantize(), path)
+    print("Saved in {}".format(path))
+
+  def load_quantized(self, path):
+    self.quantized_params = torch.load(path, map_location='cpu')
+    self.quantized_sources = {k: (v, v._version) for k, v in self.params.items()}
+    print("load checkpoint file: {}".format(path))
+
 
 
 def nn_forward_pass(params, X):
@@ -226,7 +276,8 @@ def nn_forward_backward(params, X, y=None, reg=0.0):
 def nn_train(params, loss_func, pred_func, X, y, X_val, y_val,
             learning_rate=1e-3, learning_rate_decay=0.95,
             reg=5e-6, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, replacement=False,
+            patience=None, val_probe_size=None, start_iter=0, sampler=None):
   """
   Train this neural network using stochastic gradient descent.
 
@@ -260,8 +311,23 @@ def nn_train(params, loss_func, pred_func, X, y, X_val, y_val,
   - num_iters: Number of steps to take when optimizing.
   - batch_size: Number of training examples to use per step.
   - verbose: boolean; if true print progress during optimization.
+  - replacement: boolean; if true sample minibatches with replacement as
+    sample_batch does, otherwise shuffle the data once per epoch.
+  - patience: If not None, stop once the validation accuracy has not improved
+    for this many consecutive epochs, and restore the params that gave the
+    best validation accuracy.
+  - val_probe_size: If not None, measure validation accuracy each epoch on a
+    fixed random subset of this many validation examples instead of the
+    whole of X_val.
+  - start_iter: Number of iterations already taken by an earlier call that
+    this one resumes; epoch boundaries, where accuracy is checked and the
+    learning rate decays, are counted from the start of that first call.
+    learning_rate should then be the already decayed learning rate.
+  - sampler: If not None, a BatchSampler for X and y to draw minibatches
+    from, so that a resumed run carries on through the current epoch.
 
-  Returns: A dictionary giving statistics about the training process
+  Returns: A dictionary giving statistics about the training process; with
+  patience set it also contains 'best_val_acc' and 'best_iter'.
   """
   num_train = X.shape[0]
   iterations_per_epoch = max(num_train // batch_size, 1)
@@ -271,8 +337,22 @@ def nn_train(params, loss_func, pred_func, X, y, X_val, y_val,
   train_acc_history = []
   val_acc_history = []
 
-  for it in range(num_iters):
-    X_batch, y_batch = sample_batch(X, y, num_train, batch_size)
+  if val_probe_size is not None and val_probe_size < X_val.shape[0]:
+    # Draw the probe from its own generator so that minibatches are unchanged
+    generator = torch.Generator().manual_seed(0)
+    probe = torch.randperm(X_val.shape[0], generator=generator)[:val_probe_size]
+    probe = probe.to(X_val.device)
+    X_val, y_val = X_val[probe], y_val[probe]
+
+  best_val_acc = -1.0
+  best_iter = 0
+  best_params = None
+  epochs_since_best = 0
+
+  if sampler is None:
+    sampler = BatchSampler(X, y, batch_size, replacement)
+  for it in range(start_iter, start_iter + num_iters):
+    X_batch, y_batch = sampler.next_batch()
 
     # Compute loss and gradients using the current minibatch
     loss, grads = loss_func(params, X_batch, y=y_batch, reg=reg)
@@ -307,11 +387,31 @@ def nn_train(params, loss_func, pred_func, X, y, X_val, y_val,
       # Decay learning rate
       learning_rate *= learning_rate_decay
 
-  return {
+      if patience is not None:
+        if val_acc > best_val_acc:
+          best_val_acc = val_acc
+          best_iter = it
+          best_params = {k: v.clone() for k, v in params.items()}
+          epochs_since_best = 0
+        else:
+          epochs_since_best += 1
+          if epochs_since_best >= patience:
+            if verbose:
+              print('early stopping at iteration %d / %d' % (it, num_iters))
+            break
+
+  stats = {
     'loss_history': loss_history,
     'train_acc_history': train_acc_history,
     'val_acc_history': val_acc_history,
   }
+  if patience is not None:
+    if best_params is not None:
+      for k in params:
+        params[k].copy_(best_params[k])
+    stats['best_val_acc'] = best_val_acc
+    stats['best_iter'] = best_iter
+  return stats
 
 
 def nn_predict(params, loss_func, X):
@@ -359,6 +459,365 @@ def nn_predict(params, loss_func, X):
 
 
 
+def nn_predict_chunked(params, loss_func, X, chunk_size=10000, num_threads=1):
+  """
+  Streaming version of nn_predict for large inputs: the hidden layer is only
+  materialised for one chunk at a time. See predict_in_chunks in
+  linear_classifier.py for the accepted types of X.
+  """
+  W1 = params['W1']
+  return predict_in_chunks(lambda X_chunk: nn_predict(params, loss_func, X_chunk),
+                           X, chunk_size, num_threads, W1.dtype, W1.device)
+
+
+def nn_quantize(params):
+  """
+  Export a two-layer net with int8 weights and per-channel scales; biases
+  are kept in float32. Returns a dictionary with keys W1_q, W1_scale, b1,
+  W2_q, W2_scale and b2 for use with nn_predict_quantized.
+  """
+  quantized_params = {}
+  for layer in ['1', '2']:
+    W_q, W_scale = quantize_per_channel(params['W' + layer])
+    quantized_params['W' + layer + '_q'] = W_q
+    quantized_params['W' + layer + '_scale'] = W_scale
+    quantized_params['b' + layer] = params['b' + layer].detach().cpu().float()
+  return quantized_params
+
+
+def nn_predict_quantized(quantized_params, X):
+  """
+  Same as nn_predict, but both matrix multiplies run in int8 with int32
+  accumulation on the CPU; the hidden activations are quantized per row on
+  the fly. Returns labels on the CPU.
+  """
+  h1 = quantized_linear(X, quantized_params['W1_q'], quantized_params['W1_scale'])
+  h1 = (h1 + quantized_params['b1']).clamp_(min=0)
+  scores = quantized_linear(h1, quantized_params['W2_q'], quantized_params['W2_scale'])
+  scores += quantized_params['b2']
+  return torch.argmax(scores, dim=1)
+
+
+def nn_forward_backward_sgd_(params, X, y, reg, learning_rate, workspace=None):
+  """
+  Fused training step: computes the same loss as nn_forward_backward and
+  applies the SGD update to params in place as part of the backward pass.
+  Activations and gradients are written into buffers kept in workspace, and
+  the weight gradients are never materialised: each update is a single
+  in-place addmm into the weights. dh1 is computed before W2 is updated, so
+  the step matches nn_forward_backward followed by nn_train's update.
+
+  Inputs:
+  - params, X, y, reg: Same as for nn_forward_backward
+  - learning_rate: Scalar step size
+  - workspace: Optional dictionary of buffers reused across calls
+
+  Returns:
+  - loss: Scalar tensor giving the loss before the update.
+  """
+  if workspace is None:
+    workspace = {}
+  W1, b1 = params['W1'], params['b1']
+  W2, b2 = params['W2'], params['b2']
+  N, D = X.shape
+  H, C = W2.shape
+  buf = lambda name, shape: workspace_buffer(workspace, name, shape, W1.dtype, W1.device)
+
+  # Forward pass
+  h1 = torch.addmm(b1, X, W1, out=buf('h1', (N, H))).clamp_(min=0)
+  probs = torch.addmm(b2, h1, W2, out=buf('scores', (N, C)))
+  probs -= torch.max(probs, dim=1, keepdim=True)[0]
+  probs.exp_()
+  probs /= torch.sum(probs, dim=1, keepdim=True)
+
+  rows = torch.arange(N, device=X.device)
+  loss = -torch.sum(torch.log(probs[rows, y])) / N
+  loss += reg * (torch.dot(W1.view(-1), W1.view(-1)) + torch.dot(W2.view(-1), W2.view(-1)))
+
+  # Backward pass; dscores overwrites probs
+  dscores = probs
+  dscores[rows, y] -= 1
+  dscores /= N
+  dh1 = torch.mm(dscores, W2.t(), out=buf('dh1', (N, H)))
+  dh1 *= h1 > 0
+
+  # SGD: p -= lr * (dp + 2 * reg * p)
+  decay = 1 - 2 * learning_rate * reg
+  W2.mul_(decay).addmm_(h1.t(), dscores, alpha=-learning_rate)
+  b2.sub_(torch.sum(dscores, dim=0, out=buf('db2', (C,))), alpha=learning_rate)
+  W1.mul_(decay).addmm_(X.t(), dh1, alpha=-learning_rate)
+  b1.sub_(torch.sum(dh1, dim=0, out=buf('db1', (H,))), alpha=learning_rate)
+
+  return loss
+
+
+def nn_train_fused(params, X, y, X_val, y_val,
+                   learning_rate=1e-3, learning_rate_decay=0.95,
+                   reg=5e-6, num_iters=100,
+                   batch_size=200, verbose=False, replacement=False,
+                   workspace=None):
+  """
+  Same as nn_train with nn_forward_backward and nn_predict, but every step
+  is a single call to nn_forward_backward_sgd_, which updates params in
+  place using the buffers in workspace.
+
+  Returns: A dictionary giving statistics about the training process
+  """
+  if workspace is None:
+    workspace = {}
+  num_train = X.shape[0]
+  iterations_per_epoch = max(num_train // batch_size, 1)
+
+  loss_history = []
+  train_acc_history = []
+  val_acc_history = []
+
+  sampler = BatchSampler(X, y, batch_size, replacement)
+  for it in range(num_iters):
+    X_batch, y_batch = sampler.next_batch()
+
+    loss = nn_forward_backward_sgd_(params, X_batch, y_batch, reg,
+                                    learning_rate, workspace)
+    loss_history.append(loss.item())
+
+    if verbose and it % 100 == 0:
+      print('iteration %d / %d: loss %f' % (it, num_iters, loss.item()))
+
+    # Every epoch, check train and val accuracy and decay learning rate.
+    if it % iterations_per_epoch == 0:
+      y_train_pred = nn_predict(params, nn_forward_backward, X_batch)
+      train_acc = (y_train_pred == y_batch).float().mean().item()
+      y_val_pred = nn_predict(params, nn_forward_backward, X_val)
+      val_acc = (y_val_pred == y_val).float().mean().item()
+      train_acc_history.append(train_acc)
+      val_acc_history.append(val_acc)
+
+      learning_rate *= learning_rate_decay
+
+  return {
+    'loss_history': loss_history,
+    'train_acc_history': train_acc_history,
+    'val_acc_history': val_acc_history,
+  }
+
+
+def benchmark_nn_train(data_dict, hidden_size=128, learning_rate=1e-1,
+                       reg=1e-3, num_iters=200, batch_size=200):
+  """
+  Train the same TwoLayerNet with nn_train and nn_train_fused, print the
+  iterations per second of each and the largest difference between the
+  resulting parameters.
+
+  Returns a dictionary mapping 'nn_train' and 'nn_train_fused' to their
+  iterations per second.
+  """
+  X_train, y_train = data_dict['X_train'], data_dict['y_train']
+  X_val, y_val = data_dict['X_val'], data_dict['y_val']
+
+  results = {}
+  nets = {}
+  for name in ['nn_train', 'nn_train_fused']:
+    net = TwoLayerNet(X_train.shape[1], hidden_size, 10,
+                      dtype=X_train.dtype, device=X_train.device)
+    train = net.train if name == 'nn_train' else net.train_fused
+    elapsed = time_function(
+        lambda: train(X_train, y_train, X_val, y_val, learning_rate=learning_rate,
+                      reg=reg, num_iters=num_iters, batch_size=batch_size),
+        synchronize=X_train.is_cuda)
+    results[name] = num_iters / elapsed
+    nets[name] = net
+    print('%s: %.1f iterations / sec' % (name, results[name]))
+
+  max_diff = max((nets['nn_train'].params[k] - nets['nn_train_fused'].params[k]).abs().max().item()
+                 for k in nets['nn_train'].params)
+  print('max parameter difference: %e' % max_diff)
+  return results
+
+
+def nn_forward_backward_batched(params, X, y=None, reg=None):
+  """
+  Forward and backward pass for K two-layer nets with the same hidden size,
+  whose parameters are stacked along a leading dimension. All K nets are
+  evaluated on the same minibatch with batched matrix multiplies; for each k
+  the result matches nn_forward_backward on the k-th set of parameters.
+
+  Inputs:
+  - params: a dictionary of stacked PyTorch Tensors with keys
+        W1: First layer weights; has shape (K, D, H)
+        b1: First layer biases; has shape (K, H)
+        W2: Second layer weights; has shape (K, H, C)
+        b2: Second layer biases; has shape (K, C)
+  - X: Input data of shape (N, D), shared by all K nets.
+  - y: Vector of training labels of shape (N,), or None.
+  - reg: Tensor of shape (K,) giving the regularization strength of each net.
+
+  Returns:
+  If y is None, return a tensor scores of shape (K, N, C).
+
+  If y is not None, instead return a tuple of:
+  - loss: Tensor of shape (K,) giving the loss of each net.
+  - grads: Dictionary mapping parameter names to stacked gradients, with the
+    same shapes as params.
+  """
+  W1, b1 = params['W1'], params['b1']
+  W2, b2 = params['W2'], params['b2']
+  K = W1.shape[0]
+  N, D = X.shape
+
+  fc1 = torch.baddbmm(b1.unsqueeze(1), X.expand(K, N, D), W1)
+  h1 = fc1 * (fc1 > 0)
+  scores = torch.baddbmm(b2.unsqueeze(1), h1, W2)
+  if y is None:
+    return scores
+
+  rows = torch.arange(N, device=X.device)
+  scores -= scores.max(dim=2, keepdim=True).values
+  probs = scores.exp_()
+  probs /= probs.sum(dim=2, keepdim=True)
+  data_loss = -probs[:, rows, y].log().sum(dim=1) / N
+  reg_loss = reg * ((W1 * W1).sum(dim=(1, 2)) + (W2 * W2).sum(dim=(1, 2)))
+  loss = data_loss + reg_loss
+
+  grads = {}
+  dscores = probs
+  dscores[:, rows, y] -= 1
+  dscores /= N
+
+  reg = reg.view(K, 1, 1)
+  grads['W2'] = torch.bmm(h1.transpose(1, 2), dscores) + 2 * reg * W2
+  grads['b2'] = dscores.sum(dim=1)
+
+  dh1 = torch.bmm(dscores, W2.transpose(1, 2))
+  dh1 *= h1 > 0
+
+  grads['W1'] = torch.matmul(X.t(), dh1) + 2 * reg * W1
+  grads['b1'] = dh1.sum(dim=1)
+
+  return loss, grads
+
+
+def nn_predict_batched(params, X):
+  """
+  Predict labels for X with each of K stacked two-layer nets.
+
+  Returns:
+  - y_pred: int64 tensor of shape (K, N)
+  """
+  return nn_forward_backward_batched(params, X).argmax(dim=2)
+
+
+def nn_train_batched(params, X, y, X_val, y_val, learning_rates,
+                     learning_rate_decays, regs, num_iters=100,
+                     batch_size=200, verbose=False, replacement=False):
+  """
+  Train K stacked two-layer nets at once with stochastic gradient descent.
+  Every net sees the same minibatches but has its own learning rate,
+  learning rate decay and regularization strength.
+
+  Inputs:
+  - params: a dictionary of stacked parameters, as for
+    nn_forward_backward_batched; updated in place.
+  - X, y, X_val, y_val, num_iters, batch_size, verbose, replacement: Same as
+    for nn_train.
+  - learning_rates, learning_rate_decays, regs: lists of K hyperparameters.
+
+  Returns: A dictionary giving statistics about the training process, with
+  the same keys as nn_train; each history entry is a list of K values.
+  """
+  K = params['W1'].shape[0]
+  lr = torch.tensor(learning_rates, dtype=X.dtype, device=X.device)
+  lr_decay = torch.tensor(learning_rate_decays, dtype=X.dtype, device=X.device)
+  reg = torch.tensor(regs, dtype=X.dtype, device=X.device)
+
+  num_train = X.shape[0]
+  iterations_per_epoch = max(num_train // batch_size, 1)
+
+  loss_history = []
+  train_acc_history = []
+  val_acc_history = []
+
+  sampler = BatchSampler(X, y, batch_size, replacement)
+  for it in range(num_iters):
+    X_batch, y_batch = sampler.next_batch()
+
+    loss, grads = nn_forward_backward_batched(params, X_batch, y_batch, reg)
+    loss_history.append(loss.tolist())
+
+    for param in params.keys():
+      shape = (K,) + (1,) * (params[param].dim() - 1)
+      params[param] -= lr.view(shape) * grads[param]
+
+    if verbose and it % 100 == 0:
+      print('iteration %d / %d: min loss %f' % (it, num_iters, loss.min().item()))
+
+    # Every epoch, check train and val accuracy and decay learning rate.
+    if it % iterations_per_epoch == 0:
+      train_acc = (nn_predict_batched(params, X_batch) == y_batch).float().mean(dim=1)
+      val_acc = (nn_predict_batched(params, X_val) == y_val).float().mean(dim=1)
+      train_acc_history.append(train_acc.tolist())
+      val_acc_history.append(val_acc.tolist())
+
+      lr *= lr_decay
+
+  return {
+    'loss_history': loss_history,
+    'train_acc_history': train_acc_history,
+    'val_acc_history': val_acc_history,
+  }
+
+
+def find_best_net_batched(data_dict, get_param_set_fn, max_models=25):
+  """
+  Same search as find_best_net, but all configurations that share a hidden
+  size are trained together as one stacked job with nn_train_batched, in
+  groups of at most max_models nets to bound memory. Each net starts from
+  the same seed, so it sees the same initial weights and minibatches as it
+  would in find_best_net.
+
+  Inputs:
+  - data_dict, get_param_set_fn: Same as for find_best_net
+  - max_models (int): Maximum number of nets trained together
+
+  Returns: Same as find_best_net.
+  """
+  best_net = None
+  best_stat = None
+  best_val_acc = 0.0
+
+  X_train, y_train = data_dict['X_train'], data_dict['y_train']
+  X_val, y_val = data_dict['X_val'], data_dict['y_val']
+
+  learning_rates, hidden_sizes, regularization_strengths, learning_rate_decays = get_param_set_fn()
+
+  for hs in hidden_sizes:
+    configs = list(itertools.product(learning_rates, regularization_strengths, learning_rate_decays))
+    for start in range(0, len(configs), max_models):
+      group = configs[start:start + max_models]
+      K = len(group)
+      net = TwoLayerNet(input_size=X_train.shape[1], hidden_size=hs, output_size=10,
+                        dtype=X_train.dtype, device=X_train.device)
+      params = {k: v.unsqueeze(0).repeat((K,) + (1,) * v.dim())
+                for k, v in net.params.items()}
+      stats = nn_train_batched(params, X_train, y_train, X_val, y_val,
+                               [lr for lr, _, _ in group],
+                               [lr_decay for _, _, lr_decay in group],
+                               [reg for _, reg, _ in group],
+                               num_iters=1000, batch_size=200)
+      val_acc = (nn_predict_batched(params, X_val) == y_val).float().mean(dim=1)
+
+      for k in range(K):
+        if val_acc[k].item() > best_val_acc:
+          best_net = TwoLayerNet(input_size=X_train.shape[1], hidden_size=hs,
+                                 output_size=10, dtype=X_train.dtype,
+                                 device=X_train.device)
+          best_net.params = {p: v[k].clone() for p, v in params.items()}
+          best_stat = {key: [entry[k] for entry in history]
+                       for key, history in stats.items()}
+          best_val_acc = val_acc[k].item()
+
+  return best_net, best_stat, best_val_acc
+
+
 def nn_get_search_params():
   """
   Return candidate hyperparameters for a TwoLayerNet model.
@@ -396,7 +855,7 @@ def nn_get_search_params():
   return learning_rates, hidden_sizes, regularization_strengths, learning_rate_decays
 
 
-def find_best_net(data_dict, get_param_set_fn):
+def find_best_net(data_dict, get_param_set_fn, patience=None, val_probe_size=None):
   """
   Tune hyperparameters using the validation set.
   Store your best trained TwoLayerNet model in best_net, with the return value
@@ -414,6 +873,8 @@ def find_best_net(data_dict, get_param_set_fn):
                                  regularization_strengths, learning_rate_decays)
                                  You should get hyperparameters from
                                  get_param_set_fn.
+  - patience, val_probe_size: Early stopping options passed to
+                              TwoLayerNet.train; see nn_train
 
   Returns:
   - best_net (instance): a trained TwoLayerNet instances with
@@ -452,7 +913,8 @@ def find_best_net(data_dict, get_param_set_fn):
       stats = net.train(X_train, y_train, X_val, y_val,
                           num_iters=1000, batch_size=200,
                           learning_rate=lr, learning_rate_decay=lr_decay,
-                          reg=reg, verbose=False)
+                          reg=reg, verbose=False,
+                          patience=patience, val_probe_size=val_probe_size)
 
       val_acc = (net.predict(X_val) == y_val).float().mean().item()
 
@@ -466,3 +928,133 @@ def find_best_net(data_dict, get_param_set_fn):
   #############################################################################
 
   return best_net, best_stat, best_val_acc
+
+
+def _train_net_param_set(data_dict, lr, hs, reg, lr_decay):
+  X_train, y_train = data_dict['X_train'], data_dict['y_train']
+  X_val, y_val = data_dict['X_val'], data_dict['y_val']
+  net = TwoLayerNet(input_size=X_train.shape[1], hidden_size=hs, output_size=10,
+                    dtype=X_train.dtype, device=X_train.device)
+  stats = net.train(X_train, y_train, X_val, y_val,
+                    num_iters=1000, batch_size=200,
+                    learning_rate=lr, learning_rate_decay=lr_decay,
+                    reg=reg, verbose=False)
+  val_acc = (net.predict(X_val) == y_val).float().mean().item()
+  return net.params, stats, val_acc
+
+
+def find_best_net_parallel(data_dict, get_param_set_fn, num_workers=None,
+                           threads_per_worker=1, verbose=True):
+  """
+  Same search as find_best_net, but the configurations are trained
+  concurrently in a process pool with parallel_search, and results are
+  reported as they finish. Ties in validation accuracy are broken in favour
+  of the configuration find_best_net would have kept.
+
+  Inputs:
+  - data_dict, get_param_set_fn: Same as for find_best_net; the data must be
+    on the CPU. data_dict may also be the name of a shared dataset, see
+    parallel_search
+  - num_workers, threads_per_worker: Same as for parallel_search
+  - verbose (boolean): If true, print each result as it finishes
+
+  Returns: Same as find_best_net.
+  """
+  best_net = None
+  best_stat = None
+  best_val_acc = 0.0
+
+  if isinstance(data_dict, str):
+    X_train = attach_dataset(data_dict)['X_train']
+  else:
+    X_train = data_dict['X_train']
+  configs = list(itertools.product(*get_param_set_fn()))
+  best_index = len(configs)
+  for index, (lr, hs, reg, lr_decay), (params, stats, val_acc) in parallel_search(
+      _train_net_param_set, data_dict, configs, num_workers, threads_per_worker):
+    if verbose:
+      print('lr %e hidden %d reg %e decay %f val accuracy: %f'
+            % (lr, hs, reg, lr_decay, val_acc))
+    tie = best_net is not None and val_acc == best_val_acc and index < best_index
+    if val_acc > best_val_acc or tie:
+      best_net = TwoLayerNet(input_size=X_train.shape[1], hidden_size=hs,
+                             output_size=10, dtype=X_train.dtype,
+                             device=X_train.device)
+      best_net.params = params
+      best_stat = stats
+      best_val_acc = val_acc
+      best_index = index
+
+  return best_net, best_stat, best_val_acc
+
+
+def find_best_net_halving(data_dict, get_param_set_fn, min_iters=100,
+                          max_iters=1000, eta=3, verbose=True):
+  """
+  Successive-halving version of find_best_net. Every configuration is first
+  trained for min_iters iterations; then only the best 1 / eta of them by
+  validation accuracy are kept and trained further, resuming from their
+  current params, learning rate, minibatch sampler and iteration count, so
+  that they follow the same schedule as one uninterrupted run, until the
+  survivors reach max_iters.
+  Most configurations are discarded after a short run, so the search costs
+  several times less than training all of them to max_iters.
+
+  Inputs:
+  - data_dict, get_param_set_fn: Same as for find_best_net
+  - min_iters (int): Iterations given to every configuration in the first round
+  - max_iters (int): Iterations reached by the final survivors
+  - eta (int): Keep 1 / eta of the configurations after each round, and
+    multiply the iteration budget by eta
+  - verbose (boolean): If true, print a summary of each round
+
+  Returns: Same as find_best_net. The histories in best_stat cover every
+  round that the best net was trained for.
+  """
+  X_train, y_train = data_dict['X_train'], data_dict['y_train']
+  X_val, y_val = data_dict['X_val'], data_dict['y_val']
+  batch_size = 200
+  iterations_per_epoch = max(X_train.shape[0] // batch_size, 1)
+
+  candidates = []
+  for index, (lr, hs, reg, lr_decay) in enumerate(itertools.product(*get_param_set_fn())):
+    net = TwoLayerNet(input_size=X_train.shape[1], hidden_size=hs, output_size=10,
+                      dtype=X_train.dtype, device=X_train.device)
+    candidates.append({
+      'index': index, 'net': net, 'learning_rate': lr, 'reg': reg,
+      'learning_rate_decay': lr_decay, 'iters': 0, 'val_acc': 0.0,
+      'sampler': BatchSampler(X_train, y_train, batch_size),
+      'stats': {'loss_history': [], 'train_acc_history': [], 'val_acc_history': []},
+    })
+
+  budget = min(min_iters, max_iters)
+  while True:
+    for cand in candidates:
+      num_iters = budget - cand['iters']
+      stats = cand['net'].train(X_train, y_train, X_val, y_val,
+                                num_iters=num_iters, batch_size=batch_size,
+                                learning_rate=cand['learning_rate'],
+                                learning_rate_decay=cand['learning_rate_decay'],
+                                reg=cand['reg'], verbose=False,
+                                start_iter=cand['iters'], sampler=cand['sampler'])
+      # nn_train decays the learning rate at every iteration that is a
+      # multiple of iterations_per_epoch
+      num_decays = (math.ceil(budget / iterations_per_epoch)
+                    - math.ceil(cand['iters'] / iterations_per_epoch))
+      cand['learning_rate'] *= cand['learning_rate_decay'] ** num_decays
+      for k in cand['stats']:
+        cand['stats'][k] += stats[k]
+      cand['iters'] = budget
+      cand['val_acc'] = (cand['net'].predict(X_val) == y_val).float().mean().item()
+
+    candidates.sort(key=lambda c: (-c['val_acc'], c['index']))
+    if verbose:
+      print('%d configurations trained to %d iterations; best val accuracy: %f'
+            % (len(candidates), budget, candidates[0]['val_acc']))
+    if budget >= max_iters or len(candidates) == 1:
+      break
+    candidates = candidates[:max(len(candidates) // eta, 1)]
+    budget = min(budget * eta, max_iters)
+
+  best = candidates[0]
+  return best['net'], best['stats'], best['val_acc']
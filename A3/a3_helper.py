@@ -7,6 +7,7 @@ import eecs598
 import matplotlib.pyplot as plt
 import random
 import math
+import time
 
 def hello_helper():
   """
@@ -78,6 +79,66 @@ def get_CIFAR10_data(validation_ratio = 0.02, flatten=False):
   return data_dict
 
 
+def time_function(fn, num_runs=1, num_warmup=0, synchronize=False):
+  """
+  Return the average wall-clock time in seconds of num_runs calls to fn(),
+  after num_warmup untimed calls. If synchronize is true (pass it for CUDA
+  inputs), wait for queued CUDA work before starting and stopping the
+  timer, so that asynchronous kernels are timed in full.
+  """
+  for _ in range(num_warmup):
+    fn()
+  if synchronize:
+    torch.cuda.synchronize()
+  start = time.time()
+  for _ in range(num_runs):
+    fn()
+  if synchronize:
+    torch.cuda.synchronize()
+  return (time.time() - start) / num_runs
+
+
+def compare_mixed_precision(create_model, data_dict,
+                            mixed_precision=torch.bfloat16, **solver_kwargs):
+  """
+  Train the same model once in full precision and once in mixed precision,
+  and report the differences in training speed and validation accuracy.
+
+  Inputs:
+  - create_model: A function taking no arguments that returns a freshly
+    initialized model with float32 params, e.g.
+    lambda: DeepConvNet(weight_scale='kaiming', device='cpu')
+  - data_dict: Dictionary of data passed to the Solver
+  - mixed_precision: Low-precision dtype used for the forward / backward pass;
+    the Solver only supports torch.bfloat16
+  - solver_kwargs: Other keyword arguments passed to the Solver
+
+  Returns a dictionary mapping 'float32' and the name of the low-precision
+  dtype to dictionaries with the keys 'time' and 'best_val_acc'.
+  """
+  results = {}
+  for name, dtype in [('float32', None), (str(mixed_precision), mixed_precision)]:
+    eecs598.reset_seed(0)
+    model = create_model()
+    solver = eecs598.Solver(model, data_dict, mixed_precision=dtype,
+                            **solver_kwargs)
+    elapsed = time_function(solver.train,
+                            synchronize=torch.cuda.is_available())
+    results[name] = {
+      'time': elapsed,
+      'best_val_acc': solver.best_val_acc,
+    }
+    print('%s: %.2f sec, best val acc %.4f (%d skipped steps)'
+          % (name, results[name]['time'], solver.best_val_acc,
+             solver.num_skipped_steps))
+
+  full, mixed = results['float32'], results[str(mixed_precision)]
+  print('Speedup: %.2fx; val acc difference: %+.4f'
+        % (full['time'] / mixed['time'],
+           mixed['best_val_acc'] - full['best_val_acc']))
+  return results
+
+
 ################# Visualizations #################
 
 def plot_stats(stat_dict):
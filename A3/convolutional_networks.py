@@ -4,8 +4,9 @@ WARNING: you SHOULD NOT use ".to()" or ".cuda()" in each implementation block.
 """
 import torch
 import random
+import time
 from eecs598 import Solver
-from a3_helper import svm_loss, softmax_loss
+from a3_helper import svm_loss, softmax_loss, time_function
 from fully_connected_networks import *
 
 def hello_convolutional_networks():
@@ -388,7 +389,7 @@ class DeepConvNet(object):
                batchnorm=False,
                num_classes=10, weight_scale=1e-3, reg=0.0,
                weight_initializer=None,
-               dtype=torch.float, device='cpu'):
+               dtype=torch.float, device='cpu', class_chunk_size=None):
     """
     Initialize a new network.
 
@@ -409,6 +410,9 @@ class DeepConvNet(object):
       this datatype. float is faster but less accurate, so you should use
       double for numeric gradient checking.
     - device: device to use for computation. 'cpu' or 'cuda'    
+    - class_chunk_size: If not None, the fused final linear layer and softmax
+      loss only materialize this many class scores at a time; see
+      Linear_Softmax.
     """
     self.params = {}
     self.num_layers = len(num_filters)+1
@@ -416,6 +420,7 @@ class DeepConvNet(object):
     self.batchnorm = batchnorm
     self.reg = reg
     self.dtype = dtype
+    self.class_chunk_size = class_chunk_size
   
     if device == 'cuda':
       device = 'cuda:0'
@@ -583,8 +588,9 @@ class DeepConvNet(object):
     w = self.params[f'W{self.num_layers}']
     b = self.params[f'b{self.num_layers}']
     
-    scores, cache = Linear.forward(out, w, b)
-    caches.append(cache)
+    # In train mode the last linear layer is fused with the softmax loss below
+    if y is None:
+        scores, _ = Linear.forward(out, w, b)
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
@@ -604,12 +610,12 @@ class DeepConvNet(object):
     # a factor of 0.5                                                          #
     ############################################################################
     # Replace "pass" statement with your code
-    loss, dscores = softmax_loss(scores, y)
+    loss, dx, dw, db = Linear_Softmax.forward_backward(out, w, b, y,
+                                                      self.class_chunk_size)
     for i in range(self.num_layers):
         w = self.params[f'W{i + 1}']
         loss += self.reg * torch.sum(w * w)
     
-    dx, dw, db = Linear.backward(dscores, caches.pop())
     grads[f'W{self.num_layers}'] = dw + 2 * self.reg * self.params[f'W{self.num_layers}']
     grads[f'b{self.num_layers}'] = db
     
@@ -688,6 +694,145 @@ def create_convolutional_solver_instance(data_dict, dtype, device):
   ################################################################################
   return solver
 
+def deepconvnet_cost(input_dims=(3, 32, 32), num_filters=[8, 8, 8, 8, 8],
+                     max_pools=[0, 1, 2, 3, 4], batchnorm=False, num_classes=10,
+                     batch_size=1, dtype=torch.float):
+  """
+  Estimate the cost of a DeepConvNet from its constructor arguments, without
+  building it.
+
+  Inputs:
+  - input_dims, num_filters, max_pools, batchnorm, num_classes: Same as for
+    DeepConvNet
+  - batch_size: Number of images per minibatch
+  - dtype: Data type of the params and activations
+
+  Returns a dictionary with keys:
+  - 'params': Number of learnable parameters
+  - 'param_bytes': Memory used by the params
+  - 'flops': Floating point operations of a forward pass over the minibatch,
+    counting a multiply-add as two operations
+  - 'train_flops': Estimate for a forward and backward pass (3x forward)
+  - 'activation_bytes': Memory of the activations kept in the layer caches
+    for the backward pass of one minibatch
+  """
+  element_size = torch.tensor([], dtype=dtype).element_size()
+  C, H, W = input_dims
+  params = flops = activations = 0
+  for i, F in enumerate(num_filters):
+    params += F * C * 9 + F
+    flops += 2 * F * C * 9 * H * W
+    activations += C * H * W + F * H * W  # conv input and output
+    if batchnorm:
+      params += 2 * F
+      flops += 4 * F * H * W
+      activations += 2 * F * H * W        # normalized input and output
+    activations += F * H * W              # relu output
+    if i in max_pools:
+      H, W = H // 2, W // 2
+      activations += F * H * W            # pool output
+    C = F
+
+  # Same as DeepConvNet: the final layer assumes one halving per pool
+  H, W = input_dims[1], input_dims[2]
+  fc_dim = num_filters[-1] * (H // (2 ** len(max_pools))) * (W // (2 ** len(max_pools)))
+  params += fc_dim * num_classes + num_classes
+  flops += 2 * fc_dim * num_classes
+  activations += fc_dim
+
+  return {
+    'params': params,
+    'param_bytes': params * element_size,
+    'flops': flops * batch_size,
+    'train_flops': 3 * flops * batch_size,
+    'activation_bytes': activations * batch_size * element_size,
+  }
+
+
+def search_deepconvnet(data_dict, configs, time_budget=300.0, num_epochs=1,
+                       num_train=5000, batch_size=128, max_activation_bytes=None,
+                       dtype=torch.float, device='cpu'):
+  """
+  Rank DeepConvNet configurations by validation accuracy per second of
+  training, using short Solver runs with Kaiming initialization and Adam.
+  Every configuration trains for the same number of epochs, and its best
+  validation accuracy is divided by the time that training took.
+  Configurations are tried from the cheapest to the most expensive
+  according to deepconvnet_cost, so that the time budget covers as many
+  of them as possible; a configuration is skipped once its time, predicted
+  from the seconds per training FLOP of the runs so far, would exceed what
+  is left of the budget.
+
+  Inputs:
+  - data_dict: Dictionary with keys 'X_train', 'y_train', 'X_val', 'y_val'
+  - configs: List of dictionaries, each holding DeepConvNet arguments
+    (num_filters, max_pools and optionally batchnorm and reg) and a
+    'learning_rate' for Adam
+  - time_budget: Total time in seconds for the search
+  - num_epochs: Number of epochs to train each configuration for
+  - num_train: Number of training examples used by each run
+  - batch_size: Minibatch size of each run
+  - max_activation_bytes: If not None, skip configurations whose estimated
+    activation memory for one minibatch exceeds this
+  - dtype, device: Passed to DeepConvNet and Solver
+
+  Returns a list of dictionaries with keys 'config', 'cost', 'val_acc',
+  'train_time' and 'acc_per_sec', sorted by decreasing 'acc_per_sec'.
+  """
+  input_dims = tuple(data_dict['X_train'].shape[1:])
+  small_data = {
+    'X_train': data_dict['X_train'][:num_train],
+    'y_train': data_dict['y_train'][:num_train],
+    'X_val': data_dict['X_val'],
+    'y_val': data_dict['y_val'],
+  }
+
+  candidates = []
+  for config in configs:
+    model_args = {k: v for k, v in config.items() if k != 'learning_rate'}
+    cost = deepconvnet_cost(input_dims, model_args['num_filters'],
+                            model_args['max_pools'],
+                            model_args.get('batchnorm', False),
+                            batch_size=batch_size, dtype=dtype)
+    if max_activation_bytes is not None and cost['activation_bytes'] > max_activation_bytes:
+      print('Skipping %s: %d activation bytes' % (config, cost['activation_bytes']))
+      continue
+    candidates.append((cost['train_flops'], config, model_args, cost))
+  candidates.sort(key=lambda c: c[0])
+
+  results = []
+  sec_per_flop = None
+  start_time = time.time()
+  for train_flops, config, model_args, cost in candidates:
+    remaining = time_budget - (time.time() - start_time)
+    if remaining <= 0 or (sec_per_flop is not None
+                          and sec_per_flop * train_flops > remaining):
+      print('Search time budget exhausted')
+      break
+    model = DeepConvNet(input_dims=input_dims, weight_scale='kaiming',
+                        dtype=dtype, device=device, **model_args)
+    solver = Solver(model, small_data, num_epochs=num_epochs,
+                    batch_size=batch_size, update_rule=adam,
+                    optim_config={'learning_rate': config['learning_rate']},
+                    num_val_samples=1000, verbose=False, device=device)
+    train_start = time.time()
+    solver.train()
+    train_time = time.time() - train_start
+    sec_per_flop = max(sec_per_flop or 0.0, train_time / max(train_flops, 1))
+    results.append({
+      'config': config,
+      'cost': cost,
+      'val_acc': solver.best_val_acc,
+      'train_time': train_time,
+      'acc_per_sec': solver.best_val_acc / train_time,
+    })
+    print('%s: %.2f GFLOP / iteration, val acc %f in %.1f sec'
+          % (config, cost['train_flops'] / 1e9, solver.best_val_acc, train_time))
+
+  results.sort(key=lambda r: r['acc_per_sec'], reverse=True)
+  return results
+
+
 def kaiming_initializer(Din, Dout, K=None, relu=True, device='cpu',
                         dtype=torch.float32):
   """
@@ -1099,6 +1244,111 @@ class FastMaxPool(object):
       dx = torch.zeros_like(tx)
     return dx
 
+
+class FastSpatialBatchNorm(object):
+
+  @staticmethod
+  def forward(x, gamma, beta, bn_param):
+    """
+    Spatial batch normalization that reduces directly over the (N, H, W) axes
+    instead of reshaping the input into rows. The mean and variance of each
+    channel are computed together in a single Welford pass (torch.var_mean),
+    so channels-last inputs are normalized without any permute or copy.
+
+    Inputs / outputs: Same as SpatialBatchNorm.forward. The cache only holds
+    the normalized input, the inverse standard deviation and gamma.
+    """
+    mode = bn_param['mode']
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+
+    N, C, H, W = x.shape
+    running_mean = bn_param.get('running_mean', torch.zeros(C, dtype=x.dtype, device=x.device))
+    running_var = bn_param.get('running_var', torch.zeros(C, dtype=x.dtype, device=x.device))
+
+    out, cache = None, None
+    if mode == 'train':
+      variance, mean = torch.var_mean(x, dim=(0, 2, 3), unbiased=False)
+      inv_std = (variance + eps).rsqrt()
+      x_hat = (x - mean.view(1, C, 1, 1)) * inv_std.view(1, C, 1, 1)
+      out = x_hat * gamma.view(1, C, 1, 1) + beta.view(1, C, 1, 1)
+
+      running_mean = momentum * running_mean + (1 - momentum) * mean
+      running_var = momentum * running_var + (1 - momentum) * variance
+
+      cache = (x_hat, inv_std, gamma)
+    elif mode == 'test':
+      inv_std = (running_var + eps).rsqrt()
+      scale = (gamma * inv_std).view(1, C, 1, 1)
+      shift = (beta - running_mean * gamma * inv_std).view(1, C, 1, 1)
+      out = x * scale + shift
+    else:
+      raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+    bn_param['running_mean'] = running_mean.detach()
+    bn_param['running_var'] = running_var.detach()
+
+    return out, cache
+
+  @staticmethod
+  def backward(dout, cache):
+    """
+    Simplified backward pass for FastSpatialBatchNorm, using
+
+    dx = gamma * inv_std / M * (M * dout - sum(dout) - x_hat * sum(dout * x_hat))
+
+    where M = N * H * W and the sums run over the (N, H, W) axes.
+
+    Inputs / outputs: Same as SpatialBatchNorm.backward.
+    """
+    x_hat, inv_std, gamma = cache
+    N, C, H, W = dout.shape
+    M = N * H * W
+
+    dbeta = dout.sum(dim=(0, 2, 3))
+    dgamma = (dout * x_hat).sum(dim=(0, 2, 3))
+
+    scale = (gamma * inv_std / M).view(1, C, 1, 1)
+    dx = scale * (M * dout - dbeta.view(1, C, 1, 1) - x_hat * dgamma.view(1, C, 1, 1))
+    return dx, dgamma, dbeta
+
+
+def benchmark_spatial_batchnorm(N=128, C=64, H=16, W=16, num_runs=20,
+                                dtype=torch.float, device='cpu'):
+  """
+  Compare the speed of SpatialBatchNorm against FastSpatialBatchNorm on a
+  random training-mode forward and backward pass.
+
+  Inputs:
+  - N, C, H, W: Shape of the random input
+  - num_runs: Number of forward / backward passes to average over
+  - dtype, device: Data type and device of the random input
+
+  Returns a dictionary mapping layer names to the average time in seconds
+  of one forward and backward pass.
+  """
+  x = torch.randn(N, C, H, W, dtype=dtype, device=device)
+  dout = torch.randn(N, C, H, W, dtype=dtype, device=device)
+  gamma = torch.ones(C, dtype=dtype, device=device)
+  beta = torch.zeros(C, dtype=dtype, device=device)
+
+  results = {}
+  for name, layer in [('SpatialBatchNorm', SpatialBatchNorm),
+                      ('FastSpatialBatchNorm', FastSpatialBatchNorm)]:
+    bn_param = {'mode': 'train'}
+
+    def step():
+      out, cache = layer.forward(x, gamma, beta, bn_param)
+      layer.backward(dout, cache)
+
+    results[name] = time_function(step, num_runs, num_warmup=1,
+                                  synchronize=x.is_cuda)
+    print('%s: %.3f ms per forward / backward' % (name, 1000 * results[name]))
+
+  print('Speedup: %.2fx' % (results['SpatialBatchNorm'] / results['FastSpatialBatchNorm']))
+  return results
+
+
 class Conv_ReLU(object):
 
   @staticmethod
@@ -1200,7 +1450,7 @@ class Conv_BatchNorm_ReLU(object):
   @staticmethod
   def forward(x, w, b, gamma, beta, conv_param, bn_param):
     a, conv_cache = FastConv.forward(x, w, b, conv_param)
-    an, bn_cache = SpatialBatchNorm.forward(a, gamma, beta, bn_param)
+    an, bn_cache = FastSpatialBatchNorm.forward(a, gamma, beta, bn_param)
     out, relu_cache = ReLU.forward(an)
     cache = (conv_cache, bn_cache, relu_cache)
     return out, cache
@@ -1209,7 +1459,7 @@ class Conv_BatchNorm_ReLU(object):
   def backward(dout, cache):
     conv_cache, bn_cache, relu_cache = cache
     dan = ReLU.backward(dout, relu_cache)
-    da, dgamma, dbeta = SpatialBatchNorm.backward(dan, bn_cache)
+    da, dgamma, dbeta = FastSpatialBatchNorm.backward(dan, bn_cache)
     dx, dw, db = FastConv.backward(da, conv_cache)
     return dx, dw, db, dgamma, dbeta
 
@@ -1219,7 +1469,7 @@ class Conv_BatchNorm_ReLU_Pool(object):
   @staticmethod
   def forward(x, w, b, gamma, beta, conv_param, bn_param, pool_param):
     a, conv_cache = FastConv.forward(x, w, b, conv_param)
-    an, bn_cache = SpatialBatchNorm.forward(a, gamma, beta, bn_param)
+    an, bn_cache = FastSpatialBatchNorm.forward(a, gamma, beta, bn_param)
     s, relu_cache = ReLU.forward(an)
     out, pool_cache = FastMaxPool.forward(s, pool_param)
     cache = (conv_cache, bn_cache, relu_cache, pool_cache)
@@ -1230,6 +1480,266 @@ class Conv_BatchNorm_ReLU_Pool(object):
     conv_cache, bn_cache, relu_cache, pool_cache = cache
     ds = FastMaxPool.backward(dout, pool_cache)
     dan = ReLU.backward(ds, relu_cache)
-    da, dgamma, dbeta = SpatialBatchNorm.backward(dan, bn_cache)
+    da, dgamma, dbeta = FastSpatialBatchNorm.backward(dan, bn_cache)
     dx, dw, db = FastConv.backward(da, conv_cache)
     return dx, dw, db, dgamma, dbeta
+
+
+def _int8_mm(A_q, B_q):
+  """
+  Multiply two int8 matrices with int32 accumulation, using the int8 GEMM
+  kernel where this version of PyTorch provides one for these shapes.
+  """
+  try:
+    return torch._int_mm(A_q, B_q)
+  except (AttributeError, RuntimeError):
+    return torch.mm(A_q.int(), B_q.int())
+
+
+def _fold_layers(model):
+  """
+  Describe a trained FullyConnectedNet or DeepConvNet as a list of
+  inference layers on the CPU in float32. Each layer is a dictionary with
+  its weights as a (D, M) matrix (convolution filters are flattened for an
+  im2col matmul), its bias, and whether it is followed by a ReLU and a 2x2
+  max pool. Test-mode batchnorm is folded into the preceding convolution.
+  """
+  params = {k: v.detach().cpu().float() for k, v in model.params.items()}
+  layers = []
+  if isinstance(model, DeepConvNet):
+    for i in range(model.num_layers - 1):
+      w, b = params[f'W{i + 1}'], params[f'b{i + 1}']
+      if model.batchnorm:
+        bn_param = model.bn_params[i]
+        running_mean = bn_param['running_mean'].detach().cpu().float()
+        running_var = bn_param['running_var'].detach().cpu().float()
+        scale = params[f'gamma{i + 1}'] / torch.sqrt(running_var + bn_param.get('eps', 1e-5))
+        w = w * scale.view(-1, 1, 1, 1)
+        b = (b - running_mean) * scale + params[f'beta{i + 1}']
+      layers.append({'type': 'conv', 'w': w.reshape(w.shape[0], -1).t(), 'b': b,
+                     'relu': True, 'pool': i in model.max_pools})
+  else:
+    for i in range(1, model.num_layers):
+      layers.append({'type': 'linear', 'w': params[f'W{i}'], 'b': params[f'b{i}'],
+                     'relu': True, 'pool': False})
+  L = model.num_layers
+  layers.append({'type': 'linear', 'w': params[f'W{L}'], 'b': params[f'b{L}'],
+                 'relu': False, 'pool': False})
+  return layers
+
+
+class QuantizedNet(object):
+  """
+  Int8 post-training quantized copy of a trained FullyConnectedNet or
+  DeepConvNet, for inference on the CPU.
+
+  Weights are quantized symmetrically with one scale per output channel.
+  Each layer input is quantized with a fixed per-tensor scale calibrated from
+  the largest activation seen on a few batches of calibration data. Linear
+  layers and convolutions (as im2col matmuls) run in int8 with int32
+  accumulation; the accumulators are rescaled to float for the bias, ReLU
+  and max pool, and requantized at the input of the next layer.
+  """
+
+  def __init__(self, model, calibration_X, batch_size=100):
+    """
+    Inputs:
+    - model: A trained FullyConnectedNet or DeepConvNet
+    - calibration_X: Inputs used to calibrate the activation ranges, e.g. a
+      few batches of training data
+    - batch_size: Batch size used for calibration
+    """
+    self.layers = _fold_layers(model)
+
+    absmax = [0.0] * len(self.layers)
+    for start in range(0, calibration_X.shape[0], batch_size):
+      x = calibration_X[start:start + batch_size].cpu().float()
+      for i, layer in enumerate(self.layers):
+        absmax[i] = max(absmax[i], x.abs().max().item())
+        x = self._layer_forward(x, layer, quantized=False)
+
+    for layer, m in zip(self.layers, absmax):
+      w = layer.pop('w')
+      layer['x_scale'] = max(m, 1e-12) / 127
+      layer['w_scale'] = w.abs().amax(dim=0).clamp(min=1e-12) / 127
+      layer['w_q'] = torch.round(w / layer['w_scale']).clamp(-127, 127).to(torch.int8)
+
+  @staticmethod
+  def _layer_forward(x, layer, quantized=True):
+    N = x.shape[0]
+    if quantized:
+      x = torch.round(x / layer['x_scale']).clamp_(-127, 127)
+    if layer['type'] == 'conv':
+      H, W = x.shape[2], x.shape[3]
+      x = torch.nn.functional.unfold(x, kernel_size=3, padding=1)
+      x = x.transpose(1, 2).reshape(N * H * W, -1)
+    else:
+      x = x.reshape(N, -1)
+
+    if quantized:
+      out = _int8_mm(x.to(torch.int8), layer['w_q']).float()
+      out *= layer['x_scale'] * layer['w_scale']
+    else:
+      out = x.mm(layer['w'])
+    out += layer['b']
+
+    if layer['type'] == 'conv':
+      out = out.view(N, H, W, -1).permute(0, 3, 1, 2)
+    if layer['relu']:
+      out = out.clamp(min=0)
+    if layer['pool']:
+      out = torch.nn.functional.max_pool2d(out, kernel_size=2, stride=2)
+    return out
+
+  def loss(self, X, y=None):
+    """
+    Compute class scores for X of shape (N, d_1, ..., d_k) on the CPU; only
+    test mode is supported, so y is ignored.
+    """
+    out = X.cpu().float()
+    for layer in self.layers:
+      out = self._layer_forward(out, layer)
+    return out
+
+
+def compare_quantized_net(model, calibration_X, X, y, batch_size=100, num_runs=3):
+  """
+  Quantize a trained FullyConnectedNet or DeepConvNet with QuantizedNet and
+  compare it against the float model on (X, y): print the accuracy of each,
+  the accuracy delta and the time for one pass over X. Load the float model
+  on the CPU for a like-for-like speed comparison.
+
+  Returns a tuple (qmodel, results), where results maps 'float' and 'int8'
+  to a tuple (accuracy, seconds per pass over X).
+  """
+  qmodel = QuantizedNet(model, calibration_X, batch_size)
+
+  results = {}
+  for name, net in [('float', model), ('int8', qmodel)]:
+    def run():
+      y_pred = []
+      for start in range(0, X.shape[0], batch_size):
+        y_pred.append(net.loss(X[start:start + batch_size]).argmax(dim=1).cpu())
+      return torch.cat(y_pred)
+
+    y_pred = run()  # warm up
+    elapsed = time_function(run, num_runs, synchronize=X.is_cuda)
+    results[name] = ((y_pred == y.cpu()).float().mean().item(), elapsed)
+    print('%s: accuracy %f, %.3f sec per pass' % (name, results[name][0], elapsed))
+
+  print('accuracy delta: %f, speedup: %.2fx'
+        % (results['int8'][0] - results['float'][0],
+           results['float'][1] / results['int8'][1]))
+  return qmodel, results
+
+
+def _linear_module(w, b):
+  layer = torch.nn.Linear(w.shape[0], w.shape[1])
+  layer.weight = torch.nn.Parameter(w.detach().t().clone())
+  layer.bias = torch.nn.Parameter(b.detach().clone())
+  return layer
+
+
+def _conv_module(w, b):
+  F, C, HH, WW = w.shape
+  layer = torch.nn.Conv2d(C, F, (HH, WW), stride=1, padding=(HH - 1) // 2)
+  layer.weight = torch.nn.Parameter(w.detach().clone())
+  layer.bias = torch.nn.Parameter(b.detach().clone())
+  return layer
+
+
+def _batchnorm_module(gamma, beta, bn_param):
+  C = gamma.shape[0]
+  layer = torch.nn.BatchNorm2d(C, eps=bn_param.get('eps', 1e-5),
+                               momentum=1 - bn_param.get('momentum', 0.9))
+  layer.weight = torch.nn.Parameter(gamma.detach().clone())
+  layer.bias = torch.nn.Parameter(beta.detach().clone())
+  if 'running_mean' in bn_param:
+    layer.running_mean.copy_(bn_param['running_mean'])
+    layer.running_var.copy_(bn_param['running_var'])
+  return layer
+
+
+def export_to_module(model):
+  """
+  Convert a trained FullyConnectedNet, ThreeLayerConvNet or DeepConvNet into
+  an equivalent torch.nn.Sequential in eval mode, whose forward pass
+  computes the same scores as model.loss(X). The result uses only standard
+  layers, so it can be passed to torch.jit.script or torch.compile, and its
+  state_dict can be saved and served without the assignment code.
+
+  Dropout is left out since it is the identity at test time, and batchnorm
+  layers use the running statistics in model.bn_params.
+
+  Inputs:
+  - model: A FullyConnectedNet, ThreeLayerConvNet or DeepConvNet, e.g. one
+    loaded from best_overfit_five_layer_net.pth or one_minute_deepconvnet.pth
+
+  Returns:
+  - module: torch.nn.Sequential on the device and dtype of model.params
+  """
+  p = model.params
+  layers = []
+  if isinstance(model, ThreeLayerConvNet):
+    layers += [_conv_module(p['W1'], p['b1']), torch.nn.ReLU(),
+               torch.nn.MaxPool2d(kernel_size=2, stride=2), torch.nn.Flatten(),
+               _linear_module(p['W2'], p['b2']), torch.nn.ReLU(),
+               _linear_module(p['W3'], p['b3'])]
+  elif isinstance(model, DeepConvNet):
+    for i in range(model.num_layers - 1):
+      layers.append(_conv_module(p[f'W{i + 1}'], p[f'b{i + 1}']))
+      if model.batchnorm:
+        layers.append(_batchnorm_module(p[f'gamma{i + 1}'], p[f'beta{i + 1}'],
+                                        model.bn_params[i]))
+      layers.append(torch.nn.ReLU())
+      if i in model.max_pools:
+        layers.append(torch.nn.MaxPool2d(kernel_size=2, stride=2))
+    layers += [torch.nn.Flatten(),
+               _linear_module(p[f'W{model.num_layers}'], p[f'b{model.num_layers}'])]
+  else:
+    layers.append(torch.nn.Flatten())
+    for i in range(1, model.num_layers):
+      layers += [_linear_module(p[f'W{i}'], p[f'b{i}']), torch.nn.ReLU()]
+    layers.append(_linear_module(p[f'W{model.num_layers}'], p[f'b{model.num_layers}']))
+
+  W1 = p['W1']
+  module = torch.nn.Sequential(*layers).to(dtype=W1.dtype, device=W1.device)
+  return module.eval()
+
+
+def check_export_parity(model, module, X):
+  """
+  Return the largest absolute difference between the scores of model.loss(X)
+  and module(X).
+  """
+  with torch.no_grad():
+    scores = model.loss(X)
+    module_scores = module(X.to(scores.dtype))
+  return (scores - module_scores).abs().max().item()
+
+
+def benchmark_exported_model(model, X, num_runs=20, use_compile=False):
+  """
+  Export model with export_to_module, check that it matches model.loss(X),
+  and print the latency of model.loss(X), the exported module, its
+  TorchScript version and, if use_compile is set and available, its
+  torch.compile version.
+
+  Returns a dictionary mapping each variant to its average latency in
+  seconds.
+  """
+  module = export_to_module(model)
+  print('max difference vs model.loss: %e' % check_export_parity(model, module, X))
+
+  variants = [('loss', model.loss), ('module', module),
+              ('torchscript', torch.jit.script(module))]
+  if use_compile and hasattr(torch, 'compile'):
+    variants.append(('compile', torch.compile(module)))
+
+  results = {}
+  with torch.no_grad():
+    for name, forward in variants:
+      results[name] = time_function(lambda: forward(X), num_runs, num_warmup=1,
+                                    synchronize=X.is_cuda)
+      print('%s: %.3f ms' % (name, 1000 * results[name]))
+  return results
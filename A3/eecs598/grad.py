@@ -1,3 +1,4 @@
+import multiprocessing
 import random
 
 import torch
@@ -100,6 +101,266 @@ def compute_numeric_gradient(f, x, dLdf=None, h=1e-7):
     return grad
 
 
+def compute_numeric_gradient_batched(
+    f, x, dLdf=None, h=1e-7, batch_size=64, indices=None
+):
+    """
+    Vectorized version of compute_numeric_gradient. Rather than calling f
+    twice per element of x, we stack batch_size copies of x perturbed by +h
+    and batch_size copies perturbed by -h along a new leading dimension and
+    evaluate all of them with a single call to f.
+
+    Inputs:
+    - f: A function that inputs a torch tensor of shape (B,) + x.shape holding
+      B copies of x and returns a tensor of shape (B, ...) giving the output
+      of the original function for each copy
+    - x: A torch tensor giving the point at which to compute the gradient
+    - dLdf: optional upstream gradient for intermediate layers
+    - h: epsilon used in the finite difference calculation
+    - batch_size: Number of elements of x to perturb per call to f
+    - indices: Optional int64 tensor of flat indices into x at which to compute
+      the gradient; by default the gradient is computed for every element
+    Returns:
+    - grad: A tensor of the same shape as x giving the gradient of f at x; if
+      indices is given, elements of grad outside of indices are zero
+    """
+    numel = x.numel()
+    if indices is None:
+        indices = torch.arange(numel)
+    grad = torch.zeros_like(x, memory_format=torch.contiguous_format)
+    flat_grad = grad.view(-1)
+
+    # Initialize upstream gradient to be ones if not provide
+    if dLdf is None:
+        y = f(x.unsqueeze(0))[0]
+        dLdf = torch.ones_like(y)
+    dLdf = dLdf.flatten()
+
+    for start in range(0, indices.shape[0], batch_size):
+        idx = indices[start : start + batch_size].to(x.device)
+        B = idx.shape[0]
+        rows = torch.arange(B, device=x.device)
+
+        # Rows [0, B) are x + h e_i and rows [B, 2B) are x - h e_i
+        xs = x.detach().reshape(1, numel).repeat(2 * B, 1)
+        xs[rows, idx] += h
+        xs[rows + B, idx] -= h
+        fx = f(xs.view((2 * B,) + x.shape)).reshape(2 * B, -1)
+
+        # compute the partial derivatives with centered formula
+        dfdx = (fx[:B] - fx[B:]) / (2 * h)
+
+        # use chain rule to compute dLdx
+        flat_grad[idx] = dfdx.mv(dLdf.to(dfdx.dtype)).to(grad.dtype)
+
+    return grad
+
+
+_pool_state = {}
+
+
+def _pool_init(f, x, dLdf, h):
+    # Each worker already has a forked copy of x, f and dLdf, so they do not
+    # need to be pickled; use one thread per worker to avoid oversubscription
+    torch.set_num_threads(1)
+    _pool_state.update(f=f, x=x, dLdf=dLdf, h=h)
+
+
+def _pool_partials(indices):
+    f, x, dLdf, h = (_pool_state[k] for k in ["f", "x", "dLdf", "h"])
+    flat_x = x.view(-1)
+    partials = []
+    for i in indices:
+        oldval = flat_x[i].item()  # Store the original value
+        flat_x[i] = oldval + h  # Increment by h
+        fxph = f(x).flatten()  # Evaluate f(x + h)
+        flat_x[i] = oldval - h  # Decrement by h
+        fxmh = f(x).flatten()  # Evaluate f(x - h)
+        flat_x[i] = oldval  # Restore original value
+        partials.append(dLdf.dot((fxph - fxmh) / (2 * h)).item())
+    return partials
+
+
+def compute_numeric_gradient_parallel(
+    f, x, dLdf=None, h=1e-7, indices=None, num_workers=None
+):
+    """
+    Compute the same numeric gradient as compute_numeric_gradient, splitting
+    the elements of x across a pool of worker processes. Unlike the batched
+    version, f does not need to support a batch dimension, so this also works
+    for functions such as lambda _: model.loss(X, y)[0].
+
+    The workers are forked from the current process, so f does not need to be
+    picklable but x must be a contiguous CPU tensor.
+
+    Inputs:
+    - f, x, dLdf, h: Same as compute_numeric_gradient
+    - indices: Optional int64 tensor of flat indices into x at which to compute
+      the gradient; by default the gradient is computed for every element
+    - num_workers: Number of worker processes; defaults to the number of CPUs
+    Returns:
+    - grad: A tensor of the same shape as x giving the gradient of f at x; if
+      indices is given, elements of grad outside of indices are zero
+    """
+    if x.is_cuda or not x.is_contiguous():
+        raise ValueError("x must be a contiguous CPU tensor")
+    if indices is None:
+        indices = torch.arange(x.numel())
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    grad = torch.zeros_like(x, memory_format=torch.contiguous_format)
+    flat_grad = grad.view(-1)
+
+    # Initialize upstream gradient to be ones if not provide
+    if dLdf is None:
+        y = f(x)
+        dLdf = torch.ones_like(y)
+    dLdf = dLdf.flatten()
+
+    indices = indices.tolist()
+    num_chunks = min(len(indices), 4 * num_workers)
+    chunks = [indices[i::num_chunks] for i in range(num_chunks)]
+
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(num_workers, _pool_init, (f, x, dLdf, h)) as pool:
+        for chunk, partials in zip(chunks, pool.map(_pool_partials, chunks)):
+            flat_grad[chunk] = torch.tensor(partials, dtype=grad.dtype)
+
+    return grad
+
+
+def grad_check_random(
+    f, x, analytic_grad, num_checks=100, h=1e-7, batch_size=None, num_workers=0
+):
+    """
+    Compare the analytic gradient against the numeric gradient on a random
+    subset of num_checks elements of x.
+
+    Inputs:
+    - f: A function that inputs a torch tensor and returns a torch scalar; if
+      batch_size is not None it must support a leading batch dimension as in
+      compute_numeric_gradient_batched
+    - x: A torch tensor of the point at which to evaluate the numeric gradient
+    - analytic_grad: A torch tensor giving the analytic gradient of f at x
+    - num_checks: The number of elements of x to check
+    - h: Step size for computing numeric derivatives
+    - batch_size: If not None, use compute_numeric_gradient_batched with this
+      batch size
+    - num_workers: If positive and batch_size is None, use
+      compute_numeric_gradient_parallel with this many workers
+    Returns:
+    - rel_error: Relative error between the analytic and numeric gradients on
+      the checked elements
+    """
+    # fix random seed to 0
+    eecs598.reset_seed(0)
+    indices = torch.randperm(x.numel())[:num_checks]
+
+    if batch_size is not None:
+        grad = compute_numeric_gradient_batched(
+            f, x, h=h, batch_size=batch_size, indices=indices
+        )
+    elif num_workers > 0:
+        grad = compute_numeric_gradient_parallel(
+            f, x, h=h, indices=indices, num_workers=num_workers
+        )
+    else:
+        grad = torch.zeros_like(x, memory_format=torch.contiguous_format)
+        flat_x = x.view(-1)
+        flat_grad = grad.view(-1)
+        for i in indices.tolist():
+            oldval = flat_x[i].item()
+            flat_x[i] = oldval + h
+            fxph = f(x).item()
+            flat_x[i] = oldval - h
+            fxmh = f(x).item()
+            flat_x[i] = oldval
+            flat_grad[i] = (fxph - fxmh) / (2 * h)
+
+    indices = indices.to(x.device)
+    return rel_error(grad.view(-1)[indices], analytic_grad.reshape(-1)[indices])
+
+
+def grad_check_directional(f, x, analytic_grad, num_directions=10, h=1e-7):
+    """
+    Check the analytic gradient along random directions. For a random unit
+    vector v, the directional derivative
+
+    f'(x; v) =~ (f(x + h v) - f(x - h v)) / (2h)
+
+    should match the dot product of the analytic gradient with v. Each check
+    costs two evaluations of f regardless of the size of x, so this covers
+    every element of x at once.
+
+    Inputs:
+    - f: A function that inputs a torch tensor and returns a torch scalar
+    - x: A torch tensor of the point at which to evaluate the numeric gradient
+    - analytic_grad: A torch tensor giving the analytic gradient of f at x
+    - num_directions: The number of random directions along which to check
+    - h: Step size for computing numeric derivatives
+    Returns:
+    - rel_error: The largest relative error over all directions
+    """
+    # fix random seed to 0
+    eecs598.reset_seed(0)
+    oldval = x.clone()
+    max_error = 0.0
+    for i in range(num_directions):
+        v = torch.randn_like(x)
+        v /= v.norm()
+
+        x.copy_(oldval + h * v)  # step along v
+        fxph = f(x).item()
+        x.copy_(oldval - h * v)  # step against v
+        fxmh = f(x).item()
+        x.copy_(oldval)  # reset
+
+        grad_numerical = (fxph - fxmh) / (2 * h)
+        grad_analytic = (analytic_grad * v).sum().item()
+        rel_error_top = abs(grad_numerical - grad_analytic)
+        rel_error_bot = abs(grad_numerical) + abs(grad_analytic) + 1e-12
+        max_error = max(max_error, rel_error_top / rel_error_bot)
+    return max_error
+
+
+def grad_check_model(
+    model, X, y, num_checks=20, num_directions=5, h=1e-7, num_workers=0
+):
+    """
+    Check the gradients returned by model.loss(X, y) for every parameter in
+    model.params, using directional checks along with a random subset of
+    elements. This makes it practical to check full models such as
+    DeepConvNet, where checking every element would take hours.
+
+    Inputs:
+    - model: A model following the Solver API; use dtype=torch.float64
+    - X, y: A minibatch of data and labels
+    - num_checks: Number of random elements to check for each parameter
+    - num_directions: Number of random directions to check for each parameter
+    - h: Step size for computing numeric derivatives
+    - num_workers: If positive, check the random elements of each parameter
+      with a pool of this many worker processes
+    Returns:
+    - errors: Dictionary mapping parameter names to the largest relative
+      error found for that parameter
+    """
+    _, grads = model.loss(X, y)
+    errors = {}
+    for name in sorted(model.params):
+        f = lambda _: model.loss(X, y)[0]
+        x = model.params[name]
+        dir_error = grad_check_directional(f, x, grads[name], num_directions, h)
+        elem_error = grad_check_random(
+            f, x, grads[name], num_checks, h, num_workers=num_workers
+        )
+        errors[name] = max(dir_error, elem_error)
+        print(
+            "%s relative error: %.2e (directional %.2e, elementwise %.2e)"
+            % (name, errors[name], dir_error, elem_error)
+        )
+    return errors
+
+
 def rel_error(x, y, eps=1e-10):
     """
     Compute the relative error between a pair of tensors x and y,
@@ -1,7 +1,14 @@
+import concurrent.futures
+import copy
 import pickle
+import socket
 import time
 
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from .shared_data import attach_dataset, is_tracked, unlink_dataset
 
 
 class Solver(object):
@@ -72,6 +79,9 @@ class Solver(object):
           'X_val': Array, shape (N_val, d_1, ..., d_k) of validation images
           'y_train': Array, shape (N_train,) of labels for training images
           'y_val': Array, shape (N_val,) of labels for validation images
+          or the name of a dataset with these keys shared with
+          eecs598.shared_data.share_dataset, which is attached without a copy
+          (and also attached by name in the data-parallel workers).
         Optional arguments:
         - update_rule: A function of an update rule. Default is sgd.
         - optim_config: A dictionary containing hyperparameters that will be
@@ -94,8 +104,48 @@ class Solver(object):
           accuracy; default is None, which uses the entire validation set.
         - checkpoint_name: If not None, then save model checkpoints here every
           epoch.
+        - mixed_precision: If not None, must be torch.bfloat16. The forward
+          and backward passes of model.loss then run in bfloat16 on a
+          low-precision copy of model.params, while the update rule is applied
+          to the full-precision master weights. Steps whose gradients overflow
+          are skipped. There is no loss scaling, so float16, whose small
+          gradients would underflow to zero, is not supported.
+        - num_workers: Number of processes used for data-parallel training on
+          the CPU; default is 1. If larger than 1, then num_workers - 1 worker
+          processes are spawned that share the training set through shared
+          memory. Each minibatch is split across all processes, the grads
+          returned by model.loss are summed with an all-reduce over the gloo
+          backend, and the update rule is applied once in this process.
+        - num_micro_batches: Number of chunks each minibatch is split into;
+          default is 1. If larger than 1, then model.loss is run on one chunk
+          at a time and the grads are accumulated before a single update, so
+          peak activation memory is that of one chunk while the effective
+          batch size stays batch_size. Batchnorm layers normalize each chunk
+          with its own statistics, but their running statistics are updated
+          once per minibatch with the statistics of the whole minibatch.
+        - eval_batch_size: Batch size used by check_accuracy; default is 100.
+          If "auto", then the largest batch whose estimated memory use fits in
+          eval_memory_budget is picked the first time the model is evaluated.
+        - eval_memory_budget: Memory budget in bytes for one evaluation batch
+          when eval_batch_size is "auto"; default is None, which uses half of
+          the free GPU memory on CUDA and 1 GB on the CPU.
+        - cache_eval_subsets: Boolean; if set to true then the training and
+          validation subsamples used to check accuracy are drawn once and kept
+          on the device for the whole of training, instead of being redrawn
+          and copied every epoch.
+        - async_eval: Boolean; if set to true then accuracy is checked on a
+          background thread against a snapshot of the model, so training does
+          not wait for evaluation. Implies cache_eval_subsets.
+        - unlink_dataset: Boolean; if set to true and data is the name of a
+          shared dataset, then the dataset is unlinked once training ends and
+          the data-parallel workers have exited, so that its memory is freed
+          when the last process using it closes it. Default is false.
         """
         self.model = model
+        self.dataset_name = None
+        if isinstance(data, str):
+            self.dataset_name = data
+            data = attach_dataset(data)
         self.X_train = data["X_train"]
         self.y_train = data["y_train"]
         self.X_val = data["X_val"]
@@ -113,6 +163,14 @@ class Solver(object):
         self.device = kwargs.pop("device", "cpu")
 
         self.checkpoint_name = kwargs.pop("checkpoint_name", None)
+        self.mixed_precision = kwargs.pop("mixed_precision", None)
+        self.num_workers = kwargs.pop("num_workers", 1)
+        self.num_micro_batches = kwargs.pop("num_micro_batches", 1)
+        self.eval_batch_size = kwargs.pop("eval_batch_size", 100)
+        self.eval_memory_budget = kwargs.pop("eval_memory_budget", None)
+        self.async_eval = kwargs.pop("async_eval", False)
+        self.cache_eval_subsets = kwargs.pop("cache_eval_subsets", self.async_eval)
+        self.unlink_dataset = kwargs.pop("unlink_dataset", False)
         self.print_every = kwargs.pop("print_every", 10)
         self.print_acc_every = kwargs.pop("print_acc_every", 1)
         self.verbose = kwargs.pop("verbose", True)
@@ -122,6 +180,26 @@ class Solver(object):
             extra = ", ".join('"%s"' % k for k in list(kwargs.keys()))
             raise ValueError("Unrecognized arguments %s" % extra)
 
+        if self.mixed_precision not in (None, torch.bfloat16):
+            raise ValueError(
+                "mixed_precision must be None or torch.bfloat16, got %s"
+                % self.mixed_precision
+            )
+        if self.num_workers > 1:
+            if self.device != "cpu" or self.mixed_precision is not None:
+                raise ValueError(
+                    "num_workers > 1 requires device='cpu' and no mixed_precision"
+                )
+            if self.batch_size < self.num_workers:
+                raise ValueError("batch_size must be at least num_workers")
+        if self.num_micro_batches > 1:
+            if self.num_workers > 1:
+                raise ValueError("num_micro_batches > 1 requires num_workers == 1")
+            if self.batch_size < self.num_micro_batches:
+                raise ValueError("batch_size must be at least num_micro_batches")
+        if self.async_eval and not self.cache_eval_subsets:
+            raise ValueError("async_eval requires cache_eval_subsets")
+
         self._reset()
 
     def _reset(self):
@@ -136,6 +214,9 @@ class Solver(object):
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
+        self.num_skipped_steps = 0
+        self._eval_cache = {}
+        self._tuned_eval_batch_size = None
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
@@ -151,13 +232,30 @@ class Solver(object):
         # Make a minibatch of training data
         num_train = self.X_train.shape[0]
         batch_mask = torch.randperm(num_train)[: self.batch_size]
-        X_batch = self.X_train[batch_mask].to(self.device)
-        y_batch = self.y_train[batch_mask].to(self.device)
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(X_batch, y_batch)
+        if self.num_workers > 1:
+            loss, grads = self._data_parallel_loss(batch_mask)
+        elif self.num_micro_batches > 1:
+            loss, grads = self._micro_batch_loss(
+                self.X_train[batch_mask], self.y_train[batch_mask]
+            )
+        elif self.mixed_precision is not None:
+            X_batch = self.X_train[batch_mask].to(self.device)
+            y_batch = self.y_train[batch_mask].to(self.device)
+            loss, grads = self._mixed_precision_loss(X_batch, y_batch)
+        else:
+            X_batch = self.X_train[batch_mask].to(self.device)
+            y_batch = self.y_train[batch_mask].to(self.device)
+            loss, grads = self.model.loss(X_batch, y_batch)
         self.loss_history.append(loss.item())
 
+        # Skip the update if the low-precision gradients overflowed
+        if self.mixed_precision is not None:
+            if not all(torch.isfinite(g).all() for g in grads.values()):
+                self.num_skipped_steps += 1
+                return
+
         # Perform a parameter update
         with torch.no_grad():
             for p, w in self.model.params.items():
@@ -167,23 +265,207 @@ class Solver(object):
                 self.model.params[p] = next_w
                 self.optim_configs[p] = next_config
 
-    def _save_checkpoint(self):
+    def _mixed_precision_loss(self, X_batch, y_batch):
+        """
+        Run model.loss in self.mixed_precision against a low-precision copy of
+        the master weights, and return the loss and gradients cast back to the
+        dtype of the master weights. This is called by _step() and should not
+        be called manually.
+        """
+        master_params = self.model.params
+        master_dtype = getattr(self.model, "dtype", None)
+        full_dtype = next(iter(master_params.values())).dtype
+        self.model.params = {
+            k: v.to(self.mixed_precision) for k, v in master_params.items()
+        }
+        if master_dtype is not None:
+            self.model.dtype = self.mixed_precision
+        try:
+            loss, grads = self.model.loss(X_batch.to(self.mixed_precision), y_batch)
+        finally:
+            self.model.params = master_params
+            if master_dtype is not None:
+                self.model.dtype = master_dtype
+
+        # Keep batchnorm running statistics in full precision
+        for bn_param in getattr(self.model, "bn_params", []):
+            for k in ["running_mean", "running_var"]:
+                if k in bn_param:
+                    bn_param[k] = bn_param[k].to(full_dtype)
+
+        grads = {k: g.to(master_params[k].dtype) for k, g in grads.items()}
+        return loss.to(full_dtype), grads
+
+    def _micro_batch_loss(self, X_batch, y_batch):
+        """
+        Run model.loss on num_micro_batches chunks of the minibatch in turn,
+        and return the loss and grads accumulated with each chunk weighted by
+        its share of the minibatch, which matches model.loss on the whole
+        minibatch for models without batchnorm. This is called by _step() and
+        should not be called manually.
+
+        Batchnorm running statistics are restored before every chunk, the
+        mean and variance of the chunk are read back from the update, and the
+        running statistics are then updated once with the mean and (biased)
+        variance of the whole minibatch combined from the chunks.
+        """
+        loss_fn = self.model.loss
+        if self.mixed_precision is not None:
+            loss_fn = self._mixed_precision_loss
+        bn_params = getattr(self.model, "bn_params", [])
+        start_stats = [(p.get("running_mean"), p.get("running_var")) for p in bn_params]
+        chunk_stats = [[] for _ in bn_params]
+
+        N = X_batch.shape[0]
+        weights = []
+        loss, grads = 0.0, {}
+        for X_chunk, y_chunk in zip(
+            X_batch.tensor_split(self.num_micro_batches),
+            y_batch.tensor_split(self.num_micro_batches),
+        ):
+            for p, (mean, var) in zip(bn_params, start_stats):
+                if mean is None:
+                    p.pop("running_mean", None)
+                    p.pop("running_var", None)
+                else:
+                    p["running_mean"], p["running_var"] = mean, var
+
+            weight = X_chunk.shape[0] / N
+            weights.append(weight)
+            chunk_loss, chunk_grads = loss_fn(
+                X_chunk.to(self.device), y_chunk.to(self.device)
+            )
+            loss = loss + weight * chunk_loss
+            for k, g in chunk_grads.items():
+                if k in grads:
+                    grads[k].add_(g, alpha=weight)
+                else:
+                    grads[k] = weight * g
+
+            # Invert running = momentum * running + (1 - momentum) * chunk
+            for p, (mean, var), stats in zip(bn_params, start_stats, chunk_stats):
+                momentum = p.get("momentum", 0.9)
+                old_mean = 0.0 if mean is None else mean
+                old_var = 0.0 if var is None else var
+                stats.append((
+                    (p["running_mean"] - momentum * old_mean) / (1 - momentum),
+                    (p["running_var"] - momentum * old_var) / (1 - momentum),
+                ))
+
+        # One running statistics update with the whole minibatch
+        for p, (mean, var), stats in zip(bn_params, start_stats, chunk_stats):
+            momentum = p.get("momentum", 0.9)
+            batch_mean = sum(w * m for w, (m, _) in zip(weights, stats))
+            batch_var = sum(w * (v + m * m) for w, (m, v) in zip(weights, stats))
+            batch_var = batch_var - batch_mean * batch_mean
+            old_mean = 0.0 if mean is None else mean
+            old_var = 0.0 if var is None else var
+            p["running_mean"] = momentum * old_mean + (1 - momentum) * batch_mean
+            p["running_var"] = momentum * old_var + (1 - momentum) * batch_var
+
+        return loss, grads
+
+    def _start_workers(self):
+        """
+        Spawn the worker processes used for data-parallel training and join
+        them in a gloo process group as rank 0. This is called by train() and
+        should not be called manually.
+        """
+        # A named shared dataset is attached by the workers themselves; they
+        # share our resource tracker, so tell them whether it tracks the dataset
+        X_train, y_train, tracked = None, None, False
+        if self.dataset_name is None:
+            self.X_train.share_memory_()
+            self.y_train.share_memory_()
+            X_train, y_train = self.X_train, self.y_train
+        else:
+            tracked = is_tracked(self.dataset_name)
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        init_method = "tcp://127.0.0.1:%d" % port
+
+        # Split the CPU threads between the processes
+        self._num_threads = torch.get_num_threads()
+        num_threads = max(self._num_threads // self.num_workers, 1)
+
+        ctx = mp.get_context("spawn")
+        self._workers = []
+        for rank in range(1, self.num_workers):
+            args = (rank, self.num_workers, init_method, num_threads,
+                    self.model, X_train, y_train, self.dataset_name, tracked)
+            worker = ctx.Process(target=_data_parallel_worker, args=args,
+                                 daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+        torch.set_num_threads(num_threads)
+        dist.init_process_group(
+            "gloo", init_method=init_method, rank=0, world_size=self.num_workers
+        )
+
+    def _finish_training(self):
+        """
+        Stop the data-parallel workers, then unlink the shared dataset if
+        unlink_dataset is set. This is called by train() and should not be
+        called manually.
+        """
+        if self.num_workers > 1:
+            self._stop_workers()
+        if self.unlink_dataset and self.dataset_name is not None:
+            unlink_dataset(self.dataset_name)
+
+    def _stop_workers(self):
+        """
+        Tell the data-parallel workers to exit and tear down the process group.
+        This is called by train() and should not be called manually.
+        """
+        dist.broadcast(torch.zeros(1, dtype=torch.int64), src=0)
+        for worker in self._workers:
+            worker.join()
+        dist.destroy_process_group()
+        torch.set_num_threads(self._num_threads)
+        self._workers = []
+
+    def _data_parallel_loss(self, batch_mask):
+        """
+        Send the current params and the minibatch indices to the workers, and
+        return the loss and grads all-reduced over every process. This is
+        called by _step() and should not be called manually.
+        """
+        dist.broadcast(torch.tensor([batch_mask.shape[0]]), src=0)
+        _broadcast_params(self.model)
+        dist.broadcast(batch_mask, src=0)
+        return _all_reduce_loss_and_grads(
+            self.model, self.X_train, self.y_train, batch_mask
+        )
+
+    def _save_checkpoint(self, model=None, epoch=None):
+        """
+        Save model (default self.model) as the checkpoint of epoch (default
+        self.epoch), together with the current histories.
+        """
         if self.checkpoint_name is None:
             return
+        if model is None:
+            model = self.model
+        if epoch is None:
+            epoch = self.epoch
         checkpoint = {
-            "model": self.model,
+            "model": model,
             "update_rule": self.update_rule,
             "lr_decay": self.lr_decay,
             "optim_config": self.optim_config,
             "batch_size": self.batch_size,
             "num_train_samples": self.num_train_samples,
             "num_val_samples": self.num_val_samples,
-            "epoch": self.epoch,
+            "epoch": epoch,
             "loss_history": self.loss_history,
             "train_acc_history": self.train_acc_history,
             "val_acc_history": self.val_acc_history,
         }
-        filename = "%s_epoch_%d.pkl" % (self.checkpoint_name, self.epoch)
+        filename = "%s_epoch_%d.pkl" % (self.checkpoint_name, epoch)
         if self.verbose:
             print('Saving checkpoint to "%s"' % filename)
         with open(filename, "wb") as f:
@@ -203,7 +485,67 @@ class Solver(object):
         w -= config["learning_rate"] * dw
         return w, config
 
-    def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+    def _eval_subset(self, X, y, num_samples):
+        """
+        Maybe subsample X and y to num_samples datapoints, and move them to
+        the device.
+        """
+        N = X.shape[0]
+        if num_samples is not None and N > num_samples:
+            mask = torch.randperm(N, device=self.device)[:num_samples]
+            X = X[mask]
+            y = y[mask]
+        return X.to(self.device), y.to(self.device)
+
+    def _tune_eval_batch_size(self, model, X):
+        """
+        Estimate the memory used per sample by a test-time forward pass on a
+        small probe batch, and return the largest batch size that fits in
+        eval_memory_budget.
+        """
+        probe = min(32, X.shape[0])
+        X_probe = X[:probe]
+        budget = self.eval_memory_budget
+        if torch.device(self.device).type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+            model.loss(X_probe)
+            used = torch.cuda.max_memory_allocated() - base
+            if budget is None:
+                budget = torch.cuda.mem_get_info()[0] // 2
+        else:
+            with torch.profiler.profile(profile_memory=True) as prof:
+                model.loss(X_probe)
+            used = sum(max(e.self_cpu_memory_usage, 0) for e in prof.key_averages())
+            if budget is None:
+                budget = 1 << 30
+        per_sample = max(used, 1) / probe
+        return max(1, int(budget // per_sample))
+
+    def _prepare_evaluation(self):
+        """
+        Tune the evaluation batch size and draw the cached evaluation subsets
+        up front, so that a background evaluation thread does not touch the
+        random number generator. This is called by train() and should not be
+        called manually.
+        """
+        if not self.cache_eval_subsets:
+            return
+        with torch.no_grad():
+            for key, X, y, num_samples in [
+                ("train", self.X_train, self.y_train, self.num_train_samples),
+                ("val", self.X_val, self.y_val, self.num_val_samples),
+            ]:
+                if key not in self._eval_cache:
+                    self._eval_cache[key] = self._eval_subset(X, y, num_samples)
+            if self.eval_batch_size == "auto" and self._tuned_eval_batch_size is None:
+                self._tuned_eval_batch_size = self._tune_eval_batch_size(
+                    self.model, self._eval_cache["val"][0]
+                )
+
+    def check_accuracy(self, X, y, num_samples=None, batch_size=None,
+                       cache_key=None, model=None):
         """
         Check accuracy of the model on the provided data.
         Inputs:
@@ -212,21 +554,33 @@ class Solver(object):
         - num_samples: If not None, subsample the data and only test the model
           on num_samples datapoints.
         - batch_size: Split X and y into batches of this size to avoid using
-          too much memory.
+          too much memory; default is the eval_batch_size of the solver.
+        - cache_key: If not None and cache_eval_subsets is set, the subsample
+          of X and y on the device is stored under this key and reused by
+          later calls with the same key.
+        - model: Model to evaluate; default is self.model.
         Returns:
         - acc: Scalar giving the fraction of instances that were correctly
           classified by the model.
         """
+        if model is None:
+            model = self.model
 
         # Maybe subsample the data
+        if cache_key is not None and self.cache_eval_subsets:
+            if cache_key not in self._eval_cache:
+                self._eval_cache[cache_key] = self._eval_subset(X, y, num_samples)
+            X, y = self._eval_cache[cache_key]
+        else:
+            X, y = self._eval_subset(X, y, num_samples)
         N = X.shape[0]
-        if num_samples is not None and N > num_samples:
-            mask = torch.randperm(N, device=self.device)[:num_samples]
-            N = num_samples
-            X = X[mask]
-            y = y[mask]
-        X = X.to(self.device)
-        y = y.to(self.device)
+
+        if batch_size is None:
+            batch_size = self.eval_batch_size
+            if batch_size == "auto":
+                if self._tuned_eval_batch_size is None:
+                    self._tuned_eval_batch_size = self._tune_eval_batch_size(model, X)
+                batch_size = self._tuned_eval_batch_size
 
         # Compute predictions in batches
         num_batches = N // batch_size
@@ -236,7 +590,7 @@ class Solver(object):
         for i in range(num_batches):
             start = i * batch_size
             end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
+            scores = model.loss(X[start:end])
             y_pred.append(torch.argmax(scores, dim=1))
 
         y_pred = torch.cat(y_pred)
@@ -244,6 +598,45 @@ class Solver(object):
 
         return acc.item()
 
+    def _evaluate(self, model, epoch):
+        """
+        Check train and val accuracy of model, which is either self.model or a
+        snapshot of it taken at the given epoch. Returns a tuple
+        (epoch, train_acc, val_acc, model).
+        """
+        with torch.no_grad():
+            train_acc = self.check_accuracy(
+                self.X_train, self.y_train, num_samples=self.num_train_samples,
+                cache_key="train", model=model
+            )
+            val_acc = self.check_accuracy(
+                self.X_val, self.y_val, num_samples=self.num_val_samples,
+                cache_key="val", model=model
+            )
+        return epoch, train_acc, val_acc, model
+
+    def _record_accuracy(self, epoch, train_acc, val_acc, model):
+        """
+        Append the result of _evaluate to the accuracy histories, checkpoint
+        the evaluated model under its epoch and keep track of the best params.
+        """
+        self.train_acc_history.append(train_acc)
+        self.val_acc_history.append(val_acc)
+        self._save_checkpoint(model, epoch)
+
+        if self.verbose and epoch % self.print_acc_every == 0:
+            print(
+                "(Epoch %d / %d) train acc: %f; val_acc: %f"
+                % (epoch, self.num_epochs, train_acc, val_acc)
+            )
+
+        # Keep track of the best model
+        if val_acc > self.best_val_acc:
+            self.best_val_acc = val_acc
+            self.best_params = {}
+            for k, v in model.params.items():
+                self.best_params[k] = v.clone()
+
     def train(self, time_limit=None, return_best_params=True):
         """
         Run optimization to train the model.
@@ -251,78 +644,265 @@ class Solver(object):
         num_train = self.X_train.shape[0]
         iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
+        self._prepare_evaluation()
+        executor, pending = None, None
+        if self.async_eval:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        if self.num_workers > 1:
+            self._start_workers()
         prev_time = start_time = time.time()
+        try:
+            for t in range(num_iterations):
 
-        for t in range(num_iterations):
+                cur_time = time.time()
+                if (time_limit is not None) and (t > 0):
+                    next_time = cur_time - prev_time
+                    if cur_time - start_time + next_time > time_limit:
+                        print(
+                            "(Time %.2f sec; Iteration %d / %d) loss: %f"
+                            % (
+                                cur_time - start_time,
+                                t,
+                                num_iterations,
+                                self.loss_history[-1],
+                            )
+                        )
+                        print("End of training; next iteration will exceed the time limit.")
+                        break
+                prev_time = cur_time
+
+                self._step()
 
-            cur_time = time.time()
-            if (time_limit is not None) and (t > 0):
-                next_time = cur_time - prev_time
-                if cur_time - start_time + next_time > time_limit:
+                # Maybe print training loss
+                if self.verbose and t % self.print_every == 0:
                     print(
                         "(Time %.2f sec; Iteration %d / %d) loss: %f"
                         % (
-                            cur_time - start_time,
-                            t,
+                            time.time() - start_time,
+                            t + 1,
                             num_iterations,
                             self.loss_history[-1],
                         )
                     )
-                    print("End of training; next iteration will exceed the time limit.")
-                    break
-            prev_time = cur_time
 
-            self._step()
+                # At the end of every epoch, increment the epoch counter and decay
+                # the learning rate.
+                epoch_end = (t + 1) % iterations_per_epoch == 0
+                if epoch_end:
+                    self.epoch += 1
+                    for k in self.optim_configs:
+                        self.optim_configs[k]["learning_rate"] *= self.lr_decay
 
-            # Maybe print training loss
-            if self.verbose and t % self.print_every == 0:
-                print(
-                    "(Time %.2f sec; Iteration %d / %d) loss: %f"
-                    % (
-                        time.time() - start_time,
-                        t + 1,
-                        num_iterations,
-                        self.loss_history[-1],
-                    )
-                )
-
-            # At the end of every epoch, increment the epoch counter and decay
-            # the learning rate.
-            epoch_end = (t + 1) % iterations_per_epoch == 0
-            if epoch_end:
-                self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]["learning_rate"] *= self.lr_decay
-
-            # Check train and val accuracy on the first iteration, the last
-            # iteration, and at the end of each epoch.
-            with torch.no_grad():
+                # Check train and val accuracy on the first iteration, the last
+                # iteration, and at the end of each epoch.
                 first_it = t == 0
                 last_it = t == num_iterations - 1
                 if first_it or last_it or epoch_end:
-                    train_acc = self.check_accuracy(
-                        self.X_train, self.y_train, num_samples=self.num_train_samples
-                    )
-                    val_acc = self.check_accuracy(
-                        self.X_val, self.y_val, num_samples=self.num_val_samples
-                    )
-                    self.train_acc_history.append(train_acc)
-                    self.val_acc_history.append(val_acc)
-                    self._save_checkpoint()
+                    if self.async_eval:
+                        # Evaluate a snapshot in the background; wait only for
+                        # the previous evaluation to finish.
+                        if pending is not None:
+                            self._record_accuracy(*pending.result())
+                        snapshot = copy.deepcopy(self.model)
+                        pending = executor.submit(self._evaluate, snapshot, self.epoch)
+                    else:
+                        self._record_accuracy(*self._evaluate(self.model, self.epoch))
+
+            if pending is not None:
+                self._record_accuracy(*pending.result())
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            self._finish_training()
 
-                    if self.verbose and self.epoch % self.print_acc_every == 0:
-                        print(
-                            "(Epoch %d / %d) train acc: %f; val_acc: %f"
-                            % (self.epoch, self.num_epochs, train_acc, val_acc)
-                        )
+        # At the end of training swap the best params into the model
+        if return_best_params:
+          self.model.params = self.best_params
+
+    def train_with_budget(self, time_budget, eval_fraction=0.1, num_warmup=5,
+                          return_best_params=True):
+        """
+        Train for a fixed wall-clock budget in seconds, e.g. the one minute
+        DeepConvNet. The costs of an iteration and of an accuracy check (with
+        its checkpoint) are measured online and used to size the run: the
+        number of iterations, the length of an epoch, so that the learning
+        rate decays num_epochs times within the budget, and the number of
+        accuracy checks, which are limited to about eval_fraction of the
+        budget. The plan, including the spacing of the remaining learning
+        rate decays, is revised after every accuracy check. Accuracy is
+        checked synchronously, so async_eval is not supported here.
+
+        After training, self.budget_report is a dictionary with the predicted
+        and actual number of iterations and iterations per second.
+        """
 
-                    # Keep track of the best model
-                    if val_acc > self.best_val_acc:
-                        self.best_val_acc = val_acc
-                        self.best_params = {}
-                        for k, v in self.model.params.items():
-                            self.best_params[k] = v.clone()
+        def plan(remaining, iter_cost, eval_cost):
+            num_evals = max(int(eval_fraction * remaining / max(eval_cost, 1e-6)), 1)
+            num_iters = max(int((remaining - num_evals * eval_cost) / max(iter_cost, 1e-6)), 0)
+            return num_iters, max(num_iters // num_evals, 1)
+
+        if self.async_eval:
+            raise ValueError("train_with_budget does not support async_eval")
+
+        if self.num_workers > 1:
+            self._start_workers()
+        start_time = time.time()
+        try:
+            # Measure the cost of an iteration and of an accuracy check
+            for _ in range(num_warmup):
+                self._step()
+            iter_cost = (time.time() - start_time) / max(num_warmup, 1)
+            eval_start = time.time()
+            self._record_accuracy(*self._evaluate(self.model, self.epoch))
+            eval_cost = time.time() - eval_start
+
+            remaining = time_budget - (time.time() - start_time)
+            num_iterations, eval_every = plan(remaining, iter_cost, eval_cost)
+            predicted_iterations = num_warmup + num_iterations
+            predicted_rate = 1.0 / max(iter_cost, 1e-6)
+            num_decays = 0
+            next_decay = max(num_iterations // max(self.num_epochs, 1), 1)
+            if self.verbose:
+                print(
+                    "Planned %d iterations at %.1f iterations / sec, checking "
+                    "accuracy every %d iterations"
+                    % (predicted_iterations, predicted_rate, eval_every)
+                )
+
+            t, step_time = 0, 0.0
+            next_eval = eval_every
+            while t < num_iterations:
+                step_start = time.time()
+                self._step()
+                cur_cost = time.time() - step_start
+                step_time += cur_cost
+                iter_cost = 0.9 * iter_cost + 0.1 * cur_cost
+                t += 1
+
+                if self.verbose and t % self.print_every == 0:
+                    print(
+                        "(Time %.2f sec; Iteration %d / %d) loss: %f"
+                        % (time.time() - start_time, num_warmup + t,
+                           num_warmup + num_iterations, self.loss_history[-1])
+                    )
+
+                if t >= next_decay and num_decays < self.num_epochs:
+                    num_decays += 1
+                    next_decay = t + max(
+                        (num_iterations - t) // max(self.num_epochs - num_decays, 1), 1
+                    )
+                    self.epoch += 1
+                    for k in self.optim_configs:
+                        self.optim_configs[k]["learning_rate"] *= self.lr_decay
+
+                if t >= next_eval or t == num_iterations:
+                    eval_start = time.time()
+                    self._record_accuracy(*self._evaluate(self.model, self.epoch))
+                    eval_cost = 0.5 * eval_cost + 0.5 * (time.time() - eval_start)
+
+                    # Revise the plan for the rest of the budget
+                    remaining = time_budget - (time.time() - start_time)
+                    more_iterations, eval_every = plan(remaining, iter_cost, eval_cost)
+                    num_iterations = t + more_iterations
+                    next_eval = t + eval_every
+
+                    # Spread the remaining decays over the remaining iterations
+                    decays_left = self.num_epochs - num_decays
+                    if decays_left > 0:
+                        next_decay = t + max(more_iterations // decays_left, 1)
+        finally:
+            self._finish_training()
+
+        elapsed = time.time() - start_time
+        self.budget_report = {
+            "time_budget": time_budget,
+            "elapsed": elapsed,
+            "predicted_iterations": predicted_iterations,
+            "actual_iterations": num_warmup + t,
+            "predicted_iters_per_sec": predicted_rate,
+            "actual_iters_per_sec": t / step_time if step_time > 0 else 0.0,
+        }
+        if self.verbose:
+            print(
+                "Budget %.2f sec, used %.2f sec; iterations predicted %d, actual %d; "
+                "iterations / sec predicted %.1f, actual %.1f"
+                % (time_budget, elapsed, predicted_iterations, num_warmup + t,
+                   predicted_rate, self.budget_report["actual_iters_per_sec"])
+            )
 
         # At the end of training swap the best params into the model
         if return_best_params:
-          self.model.params = self.best_params
+            self.model.params = self.best_params
+
+
+def _broadcast_params(model):
+    """
+    Copy model.params from rank 0 to every other process in the group.
+    """
+    names = sorted(model.params)
+    flat = torch.cat([model.params[k].reshape(-1) for k in names])
+    dist.broadcast(flat, src=0)
+    if dist.get_rank() != 0:
+        offset = 0
+        for k in names:
+            n = model.params[k].numel()
+            model.params[k] = flat[offset : offset + n].view_as(model.params[k])
+            offset += n
+
+
+def _all_reduce_loss_and_grads(model, X_train, y_train, batch_mask):
+    """
+    Compute the loss and grads on this process's shard of the minibatch and
+    sum them over all processes. Each shard is weighted by its share of the
+    minibatch so that the result matches model.loss on the full minibatch.
+    """
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    shard = batch_mask.tensor_split(world_size)[rank]
+    loss, grads = model.loss(X_train[shard], y_train[shard])
+
+    names = sorted(model.params)
+    weight = shard.shape[0] / batch_mask.shape[0]
+    flat = torch.cat(
+        [loss.reshape(1).to(grads[names[0]].dtype)]
+        + [grads[k].reshape(-1) for k in names]
+    )
+    flat *= weight
+    dist.all_reduce(flat)
+
+    loss, offset = flat[0], 1
+    grads = {}
+    for k in names:
+        n = model.params[k].numel()
+        grads[k] = flat[offset : offset + n].view_as(model.params[k])
+        offset += n
+    return loss, grads
+
+
+def _data_parallel_worker(rank, world_size, init_method, num_threads, model,
+                          X_train, y_train, dataset_name, tracked):
+    """
+    Main loop of a data-parallel worker process. Each step receives the
+    minibatch size, the current params and the minibatch indices from rank 0,
+    then contributes the loss and grads of its shard to the all-reduce. A
+    minibatch size of zero tells the worker to exit. If dataset_name is not
+    None, X_train and y_train are None and the training set is attached from
+    the shared dataset of that name instead; tracked says whether the
+    parent's resource tracker, which we share, already tracks it.
+    """
+    if dataset_name is not None:
+        data = attach_dataset(dataset_name, tracked=tracked)
+        X_train, y_train = data["X_train"], data["y_train"]
+    torch.set_num_threads(num_threads)
+    dist.init_process_group(
+        "gloo", init_method=init_method, rank=rank, world_size=world_size
+    )
+    size = torch.zeros(1, dtype=torch.int64)
+    while True:
+        dist.broadcast(size, src=0)
+        if size.item() == 0:
+            break
+        _broadcast_params(model)
+        batch_mask = torch.empty(size.item(), dtype=torch.int64)
+        dist.broadcast(batch_mask, src=0)
+        _all_reduce_loss_and_grads(model, X_train, y_train, batch_mask)
+    dist.destroy_process_group()
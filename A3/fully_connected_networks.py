@@ -4,7 +4,8 @@ WARNING: you SHOULD NOT use ".to()" or ".cuda()" in each implementation block.
 """
 import torch
 import random
-from a3_helper import svm_loss, softmax_loss
+import time
+from a3_helper import svm_loss, softmax_loss, time_function
 from eecs598 import Solver
 
 def hello_fully_connected_networks():
@@ -308,7 +309,7 @@ class FullyConnectedNet(object):
 
   def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                dropout=0.0, reg=0.0, weight_scale=1e-2, seed=None,
-               dtype=torch.float, device='cpu'):
+               dtype=torch.float, device='cpu', class_chunk_size=None):
     """
     Initialize a new FullyConnectedNet.
 
@@ -328,9 +329,13 @@ class FullyConnectedNet(object):
       this datatype. float is faster but less accurate, so you should use
       double for numeric gradient checking.
     - device: device to use for computation. 'cpu' or 'cuda'
+    - class_chunk_size: If not None, the fused final linear layer and softmax
+      loss only materialize this many class scores at a time; see
+      Linear_Softmax.
     """
     self.use_dropout = dropout != 0
     self.reg = reg
+    self.class_chunk_size = class_chunk_size
     self.num_layers = 1 + len(hidden_dims)
     self.dtype = dtype
     self.params = {}
@@ -390,6 +395,44 @@ class FullyConnectedNet(object):
 
     print("load checkpoint file: {}".format(path))
 
+  def sparsify(self, min_sparsity=0.5):
+    """
+    Build CSR copies of the weight matrices whose fraction of zeros is at
+    least min_sparsity; loss(X) then uses SparseLinear for those layers at
+    test time. The weight tensors and their versions are recorded, and the
+    copies are rebuilt with the same min_sparsity as soon as any weight is
+    replaced or modified in place (e.g. by magnitude_prune or by the update
+    rule of a Solver). Returns the sparsity of each weight matrix.
+    """
+    self.sparse_params = {}
+    self.sparse_min_sparsity = min_sparsity
+    self.sparse_sources = {}
+    sparsity = {}
+    for i in range(1, self.num_layers + 1):
+      W = self.params[f'W{i}']
+      self.sparse_sources[f'W{i}'] = (W, W._version)
+      sparsity[f'W{i}'] = (W == 0).float().mean().item()
+      if sparsity[f'W{i}'] >= min_sparsity:
+        self.sparse_params[i] = W.t().contiguous().to_sparse_csr()
+    return sparsity
+
+  def _sparse_params_stale(self):
+    return any(self.params.get(k) is not W or W._version != version
+               for k, (W, version) in self.sparse_sources.items())
+
+  def _sparse_scores(self, X):
+    if self._sparse_params_stale():
+      self.sparsify(self.sparse_min_sparsity)
+    layer_input = X
+    for i in range(1, self.num_layers + 1):
+      b = self.params[f'b{i}']
+      if i in self.sparse_params:
+        out = SparseLinear.forward(layer_input, self.sparse_params[i], b)
+      else:
+        out, _ = Linear.forward(layer_input, self.params[f'W{i}'], b)
+      layer_input = out.clamp_(min=0) if i < self.num_layers else out
+    return layer_input
+
   def loss(self, X, y=None):
     """
     Compute loss and gradient for the fully-connected net.
@@ -398,6 +441,10 @@ class FullyConnectedNet(object):
     X = X.to(self.dtype)
     mode = 'test' if y is None else 'train'
 
+    # Sparse inference path, see sparsify
+    if mode == 'test' and getattr(self, 'sparse_params', None):
+      return self._sparse_scores(X)
+
     # Set train/test mode for batchnorm params and dropout param since they
     # behave differently during training and testing.
     if self.use_dropout:
@@ -414,21 +461,19 @@ class FullyConnectedNet(object):
     layer_input = X
     caches = []
     
-    dropout_caches = []
-    
     for i in range(1, self.num_layers):
         W, b = self.params[f'W{i}'], self.params[f'b{i}']
-        layer_input, cache = Linear_ReLU.forward(layer_input, W, b)
-        caches.append(cache)
-        
         if self.use_dropout:
-            layer_input, dropped = Dropout.forward(layer_input, self.dropout_param)
-            dropout_caches.append(dropped)
+            layer_input, cache = Linear_ReLU_Dropout.forward(layer_input, W, b, self.dropout_param)
+        else:
+            layer_input, cache = Linear_ReLU.forward(layer_input, W, b)
+        caches.append(cache)
     
     W, b = self.params[f'W{self.num_layers}'], self.params[f'b{self.num_layers}']
     
-    scores, cache = Linear.forward(layer_input, W, b)
-    caches.append(cache)
+    # In train mode the last linear layer is fused with the softmax loss below
+    if mode == 'test':
+        scores, _ = Linear.forward(layer_input, W, b)
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
@@ -448,23 +493,21 @@ class FullyConnectedNet(object):
     # of 0.5 to simplify the expression for the gradient.                      #
     ############################################################################
     # Replace "pass" statement with your code
-    loss, dscores = softmax_loss(scores, y)
+    loss, dx, dw, db = Linear_Softmax.forward_backward(layer_input, W, b, y,
+                                                      self.class_chunk_size)
     
     for i in range(1, self.num_layers + 1):
         W = self.params[f'W{i}']
         loss += self.reg * torch.sum(W ** 2)
-        
-    dx, dw, db = Linear.backward(dscores, caches.pop())
     
     grads[f'W{self.num_layers}'] = dw + 2 * self.reg * self.params[f'W{self.num_layers}']
     grads[f'b{self.num_layers}'] = db
     
     for i in range(self.num_layers - 1, 0, -1):
-        
         if self.use_dropout:
-            dx = Dropout.backward(dx, dropout_caches.pop())
-        
-        dx, dw, db = Linear_ReLU.backward(dx, caches.pop())
+            dx, dw, db = Linear_ReLU_Dropout.backward(dx, caches.pop())
+        else:
+            dx, dw, db = Linear_ReLU.backward(dx, caches.pop())
         grads[f'W{i}'] = dw + 2 * self.reg * self.params[f'W{i}']
         grads[f'b{i}'] = db
     ############################################################################
@@ -741,3 +784,268 @@ class Dropout(object):
     elif mode == 'test':
       dx = dout
     return dx
+
+
+def _pack_mask(mask):
+  """
+  Pack a boolean mask into a flat uint8 tensor holding 8 mask bits per byte.
+
+  Inputs:
+  - mask: Boolean tensor of any shape
+
+  Returns:
+  - packed: uint8 tensor of shape (ceil(mask.numel() / 8),)
+  """
+  flat = mask.flatten()
+  pad = (-flat.shape[0]) % 8
+  if pad > 0:
+    flat = torch.cat([flat, flat.new_zeros(pad)])
+  bits = 2 ** torch.arange(8, dtype=torch.uint8, device=mask.device)
+  return (flat.view(-1, 8).byte() * bits).sum(dim=1, dtype=torch.uint8)
+
+
+def _unpack_mask(packed, shape):
+  """
+  Inverse of _pack_mask.
+
+  Inputs:
+  - packed: uint8 tensor produced by _pack_mask
+  - shape: Shape of the original mask
+
+  Returns:
+  - mask: Boolean tensor of the given shape
+  """
+  numel = 1
+  for d in shape:
+    numel *= d
+  bits = 2 ** torch.arange(8, dtype=torch.uint8, device=packed.device)
+  flat = packed.unsqueeze(1).bitwise_and(bits).ne(0).flatten()
+  return flat[:numel].view(shape)
+
+
+class Linear_ReLU_Dropout(object):
+
+  @staticmethod
+  def forward(x, w, b, dropout_param):
+    """
+    Fused layer that performs a linear transform, a ReLU and (inverted)
+    dropout. The ReLU and dropout masks are combined into a single boolean
+    mask that is stored bit-packed as uint8, so the cache holds one bit per
+    activation instead of the pre-activation and a float dropout mask.
+
+    Inputs:
+    - x: Input to the linear layer, of shape (N, d_1, ..., d_k)
+    - w, b: Weights for the linear layer
+    - dropout_param: Same as for Dropout.forward
+    Returns a tuple of:
+    - out: Output from the dropout layer, of shape (N, M)
+    - cache: Object to give to the backward pass
+    """
+    p, mode = dropout_param['p'], dropout_param['mode']
+    if 'seed' in dropout_param:
+      torch.manual_seed(dropout_param['seed'])
+
+    N = x.shape[0]
+    out = torch.addmm(b, x.reshape(N, -1), w)
+    mask = out > 0
+    scale = 1.0
+    if mode == 'train':
+      mask &= torch.rand_like(out) < (1 - p)
+      scale = 1.0 / (1 - p)
+    out.mul_(mask)
+    if scale != 1.0:
+      out.mul_(scale)
+
+    cache = (x, w, _pack_mask(mask), out.shape, scale)
+    return out, cache
+
+  @staticmethod
+  def backward(dout, cache):
+    """
+    Backward pass for the fused linear-relu-dropout layer.
+    """
+    x, w, packed_mask, shape, scale = cache
+    da = dout * _unpack_mask(packed_mask, shape)
+    if scale != 1.0:
+      da.mul_(scale)
+
+    N = x.shape[0]
+    dx = da.mm(w.t()).reshape(x.shape)
+    dw = x.reshape(N, -1).t().mm(da)
+    db = da.sum(dim=0)
+    return dx, dw, db
+
+
+class Linear_Softmax(object):
+
+  @staticmethod
+  def forward_backward(x, w, b, y, chunk_size=None):
+    """
+    Fused final linear layer and softmax loss. Computes the same loss and
+    gradients as Linear.forward, softmax_loss and Linear.backward, but never
+    builds the shifted logits, exponentials and probabilities as separate
+    (N, C) tensors. With chunk_size set, the classes are processed in chunks
+    of at most chunk_size: a first pass accumulates a running log-sum-exp and
+    the scores of the correct classes, and a second pass recomputes each
+    chunk of scores to form its gradient, so at most (N, chunk_size) scores
+    exist at any time.
+
+    Inputs:
+    - x: Input data, of shape (N, d_1, ..., d_k)
+    - w: Weights, of shape (D, C)
+    - b: Biases, of shape (C,)
+    - y: Vector of labels, of shape (N,)
+    - chunk_size: Number of classes per chunk, or None for a single chunk
+    Returns a tuple of:
+    - loss: Scalar giving the loss
+    - dx: Gradient with respect to x, of shape (N, d_1, ..., d_k)
+    - dw: Gradient with respect to w, of shape (D, C)
+    - db: Gradient with respect to b, of shape (C,)
+    """
+    N = x.shape[0]
+    x_reshaped = x.reshape(N, -1)
+    C = w.shape[1]
+    if chunk_size is None:
+      chunk_size = C
+    chunks = [(start, min(start + chunk_size, C)) for start in range(0, C, chunk_size)]
+    rows = torch.arange(N, device=x.device)
+
+    # First pass: running log-sum-exp and the score of the correct class
+    m = x_reshaped.new_full((N,), -float('inf'))
+    sum_exp = x_reshaped.new_zeros(N)
+    correct = x_reshaped.new_zeros(N)
+    for start, end in chunks:
+      scores = torch.addmm(b[start:end], x_reshaped, w[:, start:end])
+      m_new = torch.maximum(m, scores.max(dim=1).values)
+      sum_exp = sum_exp * torch.exp(m - m_new) + torch.exp(scores - m_new.unsqueeze(1)).sum(dim=1)
+      m = m_new
+      in_chunk = (y >= start) & (y < end)
+      correct[in_chunk] = scores[rows[in_chunk], y[in_chunk] - start]
+    lse = m + torch.log(sum_exp)
+    loss = (lse - correct).sum() / N
+
+    # Second pass: gradient of each chunk of scores
+    dx = torch.zeros_like(x_reshaped)
+    dw = torch.empty_like(w)
+    db = torch.empty_like(b)
+    for start, end in chunks:
+      if len(chunks) > 1:
+        scores = torch.addmm(b[start:end], x_reshaped, w[:, start:end])
+      dscores = scores.sub_(lse.unsqueeze(1)).exp_()
+      in_chunk = (y >= start) & (y < end)
+      dscores[rows[in_chunk], y[in_chunk] - start] -= 1
+      dscores /= N
+      dw[:, start:end] = x_reshaped.t().mm(dscores)
+      db[start:end] = dscores.sum(dim=0)
+      dx.addmm_(dscores, w[:, start:end].t())
+    return loss, dx.reshape(x.shape), dw, db
+
+
+class SparseLinear(object):
+
+  @staticmethod
+  def forward(x, w_t, b):
+    """
+    Inference-only linear layer whose weights are stored as a sparse CSR
+    matrix, so the cost of the matrix multiply scales with the number of
+    nonzero weights.
+
+    Inputs:
+    - x: Input data, of shape (N, d_1, ..., d_k)
+    - w_t: Sparse CSR tensor of shape (M, D) holding the transposed weights
+    - b: Biases, of shape (M,)
+    Returns:
+    - out: output, of shape (N, M)
+    """
+    N = x.shape[0]
+    out = torch.sparse.mm(w_t, x.reshape(N, -1).t()).t()
+    return out + b
+
+
+def magnitude_prune(params, sparsity, block_size=None):
+  """
+  Zero out the smallest-magnitude entries of each weight matrix W1, W2, ...
+  in params, in place; biases are left dense.
+
+  Inputs:
+  - params: Dictionary of model parameters, e.g. FullyConnectedNet.params
+  - sparsity: Fraction of the weights in each matrix to set to zero
+  - block_size: If not None, prune whole block_size x block_size tiles ranked
+    by their L1 norm instead of individual weights; contiguous runs of zeros
+    give a better memory access pattern for the sparse kernels.
+
+  Returns:
+  - masks: Dictionary mapping each pruned weight name to its boolean mask of
+    kept weights, e.g. to re-apply after fine-tuning.
+  """
+  masks = {}
+  for k, w in params.items():
+    if not k.startswith('W'):
+      continue
+    scores = w.abs()
+    if block_size is not None:
+      D, M = w.shape
+      pad_d, pad_m = (-D) % block_size, (-M) % block_size
+      padded = torch.nn.functional.pad(scores, (0, pad_m, 0, pad_d))
+      scores = padded.view((D + pad_d) // block_size, block_size,
+                           (M + pad_m) // block_size, block_size).sum(dim=(1, 3))
+    mask = torch.ones_like(scores, dtype=torch.bool)
+    num_pruned = int(sparsity * scores.numel())
+    if num_pruned > 0:
+      threshold = scores.flatten().kthvalue(num_pruned).values
+      mask = scores > threshold
+    if block_size is not None:
+      mask = mask.repeat_interleave(block_size, dim=0) \
+                 .repeat_interleave(block_size, dim=1)[:D, :M]
+    w.mul_(mask)
+    masks[k] = mask
+  return masks
+
+
+def sparse_throughput_curve(model, X, sparsities=(0.0, 0.5, 0.75, 0.9, 0.95, 0.99),
+                            block_size=None, num_runs=10):
+  """
+  Measure test-time throughput of a trained FullyConnectedNet as its weights
+  are pruned to increasing sparsity, comparing the dense path with the
+  SparseLinear path. The model's params are restored afterwards.
+
+  Inputs:
+  - model: A FullyConnectedNet
+  - X: Input data to score
+  - sparsities: Fractions of weights to prune, in increasing order
+  - block_size: Passed to magnitude_prune
+  - num_runs: Number of forward passes to average over
+
+  Returns a list of tuples (sparsity, dense samples / sec, sparse samples / sec,
+  fraction of predictions that agree between the pruned and unpruned model).
+  """
+  params = {k: v.clone() for k, v in model.params.items()}
+  sparse_state = {k: getattr(model, k, None) for k in
+                  ['sparse_params', 'sparse_min_sparsity', 'sparse_sources']}
+
+  def throughput():
+    return X.shape[0] / time_function(lambda: model.loss(X), num_runs,
+                                      num_warmup=1, synchronize=X.is_cuda)
+
+  model.sparse_params = None
+  y_ref = model.loss(X).argmax(dim=1)
+  results = []
+  try:
+    for sparsity in sparsities:
+      model.params = {k: v.clone() for k, v in params.items()}
+      magnitude_prune(model.params, sparsity, block_size)
+      model.sparse_params = None
+      dense = throughput()
+      model.sparsify(min_sparsity=0.0)
+      sparse = throughput()
+      agreement = (model.loss(X).argmax(dim=1) == y_ref).float().mean().item()
+      results.append((sparsity, dense, sparse, agreement))
+      print('sparsity %.2f: dense %.0f samples / sec, sparse %.0f samples / sec, '
+            'agreement %.4f' % (sparsity, dense, sparse, agreement))
+  finally:
+    # The restored params are new tensors, so any CSR copies are rebuilt
+    # with the original min_sparsity on the next sparse forward pass
+    model.params = params
+    for k, v in sparse_state.items():
+      setattr(model, k, v)
+  return results
@@ -1,4 +1,4 @@
-from . import data, grad, submit
+from . import data, grad, shared_data, submit
 from .solver import Solver
 from .utils import reset_seed
 from .vis import tensor_to_image, visualize_dataset